@@ -2,7 +2,6 @@ from collections import OrderedDict
 import importlib
 import logging
 import os
-import shutil
 
 from ipyxact.ipyxact import Component
 from fusesoc import utils
@@ -57,6 +56,7 @@ class Core:
             else:
                 setattr(self, s, None)
 
+        self.core_file = core_file
         self.core_root = os.path.dirname(core_file)
         self.files_root = self.core_root
 
@@ -142,7 +142,7 @@ class Core:
 
     def get_depends(self, flags={}):
         self._debug("Getting dependencies for flags {}".format(str(flags)))
-        _depends = self.depend
+        _depends = self.depend[:]
         try:
             _depends += getattr(self, flags['tool']).depend
         except (AttributeError, KeyError):
@@ -306,11 +306,7 @@ class Core:
         if self.provider:
             self.provider.fetch()
 
-    def export(self, dst_dir, flags={}):
-        if os.path.exists(dst_dir):
-            shutil.rmtree(dst_dir)
-
-
+    def export(self, dst_dir, flags={}, mode='copy'):
         src_files = [f.name for f in self.get_files(flags)]
         if self.vpi and flags['tool'] in ['icarus', 'modelsim', 'rivierapro']:
             src_files += [f.name for f in self.vpi.src_files + self.vpi.include_files]
@@ -328,15 +324,20 @@ class Core:
         for f in src_files:
             if not os.path.isabs(f):
                 if(os.path.exists(os.path.join(self.core_root, f))):
-                    shutil.copy2(os.path.join(self.core_root, f),
-                                    os.path.join(dst_dir, f))
+                    utils.export_file(os.path.join(self.core_root, f),
+                                      os.path.join(dst_dir, f),
+                                      mode)
                 elif (os.path.exists(os.path.join(self.files_root, f))):
-                    shutil.copy2(os.path.join(self.files_root, f),
-                                    os.path.join(dst_dir, f))
+                    utils.export_file(os.path.join(self.files_root, f),
+                                      os.path.join(dst_dir, f),
+                                      mode)
                 else:
                     raise RuntimeError('Cannot find %s in :\n\t%s\n\t%s'
                                   % (f, self.files_root, self.core_root))
 
+        #Files from earlier exports are kept if they are up to date
+        utils.prune_export(dst_dir, [f for f in src_files if not os.path.isabs(f)])
+
     def _get_flow(self, flags):
         flow = None
         if 'tool' in flags:
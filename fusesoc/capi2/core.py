@@ -1,8 +1,8 @@
 #FIXME: Add IP-XACT support
+from collections import OrderedDict, namedtuple
 import logging
 import os
-from pyparsing import Forward, OneOrMore, Optional, Suppress, Word, alphanums
-import shutil
+from pyparsing import Forward, OneOrMore, Optional, ParseResults, Suppress, Word, alphanums
 import yaml
 
 from fusesoc import utils
@@ -32,30 +32,130 @@ class File(object):
 class Genparams(dict):
     pass
 
+#Everything a target of a core provides for a set of flags. Instances
+#are cached by Core.resolve and must not be modified
+ResolvedTarget = namedtuple('ResolvedTarget', ['target',
+                                               'filesets',
+                                               'files',
+                                               'depends',
+                                               'parameters',
+                                               'tool_options',
+                                               'vpi',
+                                               'generate'])
+
+class Conditional(object):
+    """A compiled ``flag? ( expr )`` or ``!flag? ( expr )`` expression"""
+    __slots__ = ['negate', 'cond', 'expr']
+
+    def __init__(self, negate, cond, expr):
+        self.negate = negate
+        self.cond   = cond
+        self.expr   = expr
+
+def _cb_conditional(s, l, t):
+    expr = t.expr
+    if not isinstance(expr, ParseResults):
+        expr = [expr]
+    return Conditional(t.negate == '!', t.cond, tuple(expr))
+
+#The grammar is only built once. Strings are compiled into a tuple of
+#words and Conditional objects that can be evaluated for any flag set
+_word = Word(alphanums+':<>.[]_-,=~/')
+_conditional = Forward()
+_conditional << (Optional("!")("negate") + _word("cond") + Suppress('?') + Suppress('(') + OneOrMore(_conditional ^ _word)("expr") + Suppress(')')).setParseAction(_cb_conditional)
+_string_list = OneOrMore(_conditional ^ _word)
+
+def _evaluate(tokens, flags, result):
+    for t in tokens:
+        if isinstance(t, Conditional):
+            if (t.cond in flags) != t.negate:
+                _evaluate(t.expr, flags, result)
+        else:
+            result.append(t)
+    return result
+
+def _conditions(tokens, result):
+    for t in tokens:
+        if isinstance(t, Conditional):
+            result.add(t.cond)
+            _conditions(t.expr, result)
+    return result
+
+def _words(tokens, result):
+    for t in tokens:
+        if isinstance(t, Conditional):
+            _words(t.expr, result)
+        else:
+            result.add(t)
+    return result
+
+def _bounded_insert(cache, key, value, size):
+    if len(cache) >= size:
+        cache.popitem(last=False)
+    cache[key] = value
+
+FLAGS_CACHE_SIZE  = 256
+STRING_CACHE_SIZE = 64
+
+_frozen_flags = OrderedDict()
+
+def frozen_flags(flags):
+    """Convert a flags dict to a frozenset of the flag names that can be
+    tested in CAPI2 expressions. A flag set to True is added by name and
+    a flag with a string value as name_value. Results are cached"""
+    try:
+        key = frozenset(flags.items())
+        return _frozen_flags[key]
+    except KeyError:
+        pass
+    except TypeError:
+        key = None
+    _flags = set()
+    for k,v in flags.items():
+        if v == True:
+            _flags.add(k)
+        elif v in [False, None]:
+            pass
+        else:
+            _flags.add(k+'_'+v)
+    _flags = frozenset(_flags)
+    if key is not None:
+        _bounded_insert(_frozen_flags, key, _flags, FLAGS_CACHE_SIZE)
+    return _flags
+
 class String(str):
+    def compile(self):
+        try:
+            return self._compiled
+        except AttributeError:
+            self._compiled = tuple(_string_list.parseString(self.__str__()))
+            self._conditions = frozenset(_conditions(self._compiled, set()))
+            self._results = OrderedDict()
+            return self._compiled
+
+    def conditions(self):
+        """Return the flag names referenced by the expression"""
+        self.compile()
+        return self._conditions
+
+    def words(self):
+        """Return all words the expression can evaluate to"""
+        return _words(self.compile(), set())
+
     def parse(self, flags):
-        _flags = []
-        for k,v in flags.items():
-            if v == True:
-                _flags.append(k)
-            elif v in [False, None]:
-                pass
-            else:
-                _flags.append(k+'_'+v)
+        _flags = frozen_flags(flags)
+        compiled = self.compile()
 
-        def cb_conditional(s,l,t):
-            if (t.cond in _flags) != (t.negate == '!'):
-                return t.expr
-            else:
-                return []
-        word = Word(alphanums+':<>.[]_-,=~/')
-        conditional = Forward()
-        conditional << (Optional("!")("negate") + word("cond") + Suppress('?') + Suppress('(') + OneOrMore(conditional ^ word)("expr") + Suppress(')')).setParseAction(cb_conditional)
-        string = word
-        string_list = OneOrMore(conditional ^ string)
-        s = ' '.join(string_list.parseString(self.__str__()))
-        logger.debug("Parsing '{}' with flags {} => {}".format(self.__str__(),
-                                                               str(_flags),s))
+        #Only the flags referenced by the expression affect the result
+        key = _flags & self._conditions
+        try:
+            s = self._results[key]
+        except KeyError:
+            s = ' '.join(_evaluate(compiled, key, []))
+            _bounded_insert(self._results, key, s, STRING_CACHE_SIZE)
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Parsing '{}' with flags {} => {}".format(self.__str__(),
+                                                                   str(sorted(_flags)),s))
         return s
 
 class StringOrList(object):
@@ -115,10 +215,12 @@ class Core:
     def __init__(self, core_file, cache_root=''):
         basename = os.path.basename(core_file)
 
+        self.core_file = core_file
         self.core_root = os.path.dirname(core_file)
 
         try:
-            _root = Root(yaml.safe_load(open(core_file)))
+            with open(core_file) as f:
+                _root = Root(utils.yaml_load(f))
         except KeyError as e:
             raise SyntaxError("Unknown item {}".format(e))
         except (yaml.scanner.ScannerError, yaml.constructor.ConstructorError) as e:
@@ -161,16 +263,13 @@ class Core:
         else:
             return 'local'
 
-    def export(self, dst_dir, flags={}):
-        if os.path.exists(dst_dir):
-            shutil.rmtree(dst_dir)
-
+    def export(self, dst_dir, flags={}, mode='copy'):
         src_files = [f.name for f in self.get_files(flags)]
 
 
         for k, v in self._get_vpi(flags).items():
             src_files += [f.name for f in v['src_files'] + v['inc_files']] #FIXME include files
-        self._debug("Exporting {}".format(str(src_files)))
+        self._debug("Exporting {}", src_files)
 
         for scripts in self._get_script_names(flags).values():
             for script in scripts:
@@ -185,15 +284,20 @@ class Core:
         for f in src_files:
             if not os.path.isabs(f):
                 if(os.path.exists(os.path.join(self.core_root, f))):
-                    shutil.copyfile(os.path.join(self.core_root, f),
-                                    os.path.join(dst_dir, f))
+                    utils.export_file(os.path.join(self.core_root, f),
+                                      os.path.join(dst_dir, f),
+                                      mode)
                 elif (os.path.exists(os.path.join(self.files_root, f))):
-                    shutil.copyfile(os.path.join(self.files_root, f),
-                                    os.path.join(dst_dir, f))
+                    utils.export_file(os.path.join(self.files_root, f),
+                                      os.path.join(dst_dir, f),
+                                      mode)
                 else:
                     raise RuntimeError('Cannot find %s in :\n\t%s\n\t%s'
                                   % (f, self.files_root, self.core_root))
 
+        #Files from earlier exports are kept if they are up to date
+        utils.prune_export(dst_dir, [f for f in src_files if not os.path.isabs(f)])
+
     def _get_script_names(self, flags):
         target = self._get_target(flags)
         hooks = {}
@@ -211,7 +315,7 @@ class Core:
         return hooks
 
     def get_scripts(self, files_root, flags):
-        self._debug("Getting hooks for flags '{}'".format(str(flags)))
+        self._debug("Getting hooks for flags '{}'", flags)
         hooks = {}
 
         for hook, scripts in self._get_script_names(flags).items():
@@ -224,11 +328,11 @@ class Core:
                            'env'  : env}
                 hooks[hook].append(_script)
                 _s = " Matched {} hook {}"
-                self._debug(_s.format(hook, str(_script)))
+                self._debug(_s, hook, _script)
         return hooks
 
     def get_tool(self, flags):
-        self._debug("Getting tool for flags {}".format(str(flags)))
+        self._debug("Getting tool for flags {}", flags)
         tool = None
         if flags.get('tool'):
             tool = flags['tool']
@@ -240,7 +344,7 @@ class Core:
                 tool = str(target.default_tool)
 
         if tool:
-            self._debug(" Matched tool {}".format(tool))
+            self._debug(" Matched tool {}", tool)
         else:
             self._debug(" Matched no tool")
         return tool
@@ -248,7 +352,7 @@ class Core:
     def get_tool_options(self, flags):
         _flags = flags.copy()
 
-        self._debug("Getting tool options for flags {}".format(str(_flags)))
+        self._debug("Getting tool options for flags {}", _flags)
         target = self._get_target(_flags)
         section = None
         try:
@@ -268,12 +372,12 @@ class Core:
                     _member = getattr(section, member)
                     if _member:
                         options[member] = [str(x) for x in _member]
-        self._debug("Found tool options {}".format(str(options)))
+        self._debug("Found tool options {}", options)
         return options
 
     def get_depends(self, flags): #Add use flags?
         depends = []
-        self._debug("Getting dependencies for flags {}".format(str(flags)))
+        self._debug("Getting dependencies for flags {}", flags)
         for fs in self._get_filesets(flags):
             depends += [Vlnv(d) for d in self._parse_list(flags, fs.depend)]
         return depends
@@ -285,16 +389,16 @@ class Core:
         return src_files
 
     def get_generators(self, flags):
-        self._debug("Getting generators for flags {}".format(str(flags)))
+        self._debug("Getting generators for flags {}", flags)
         generators = {}
         for k,v in self.generators.items():
             generators[k] = v
             generators[k].root = self.files_root
-            self._debug(" Found generator " + k)
+            self._debug(" Found generator {}", k)
         return generators
 
     def get_parameters(self, flags={}):
-        self._debug("Getting parameters for flags '{}'".format(str(flags)))
+        self._debug("Getting parameters for flags '{}'", flags)
         target = self._get_target(flags)
         parameters = {}
 
@@ -350,24 +454,24 @@ class Core:
                             parameters[p]['default'] = int(default,0)
                     else:
                         parameters[p]['default'] = str(default)
-        self._debug("Found parameters {}".format(parameters))
+        self._debug("Found parameters {}", parameters)
         return parameters
 
     def get_toplevel(self, flags):
         _flags = flags.copy()
         _flags['is_toplevel'] = True #FIXME: Is this correct?
-        self._debug("Getting toplevel for flags {}".format(str(_flags)))
+        self._debug("Getting toplevel for flags {}", _flags)
         target = self._get_target(_flags)
         if target.toplevel:
             toplevel = self._parse_list(_flags, target.toplevel)
-            self._debug("Matched toplevel {}".format(toplevel))
+            self._debug("Matched toplevel {}", toplevel)
             return ' '.join(toplevel)
         else:
             s = "{} : Target '{}' has no toplevel"
             raise SyntaxError(s.format(self.name, target.name))
 
     def get_ttptttg(self, flags):
-        self._debug("Getting ttptttg for flags {}".format(str(flags)))
+        self._debug("Getting ttptttg for flags {}", flags)
         target = self._get_target(flags)
         ttptttg = []
 
@@ -376,7 +480,7 @@ class Core:
 
         _ttptttg = self._parse_list(flags, target.generate)
         if _ttptttg:
-            self._debug(" Matched generator instances {}".format(_ttptttg))
+            self._debug(" Matched generator instances {}", _ttptttg)
         for gen in _ttptttg:
             if not gen in self.generate:
                 raise SyntaxError("Generator instance '{}', requested by target '{}', was not found".format(gen, target.name))
@@ -425,11 +529,11 @@ class Core:
         return vpi
 
     def get_vpi(self, flags):
-        self._debug("Getting VPI libraries for flags {}".format(flags))
+        self._debug("Getting VPI libraries for flags {}", flags)
         target = self._get_target(flags)
         vpi = []
         _vpi = self._get_vpi(flags)
-        self._debug(" Matched VPI libraries {}".format([v for v in _vpi]))
+        self._debug(" Matched VPI libraries {}", [v for v in _vpi])
         for k, v in sorted(_vpi.items()):
             vpi.append({'name'         : k,
                         'src_files'    : [f.name for f in v['src_files']],
@@ -479,26 +583,106 @@ Targets:
             if self.provider.fetch():
                 self.patch(self.files_root)
 
-    def _debug(self, msg):
-        logger.debug("{} : {}".format(str(self.name), msg))
+    def _debug(self, msg, *args):
+        #Called in hot paths, so only format the message when it is used
+        if logger.isEnabledFor(logging.DEBUG):
+            if args:
+                msg = msg.format(*args)
+            logger.debug("{} : {}".format(str(self.name), msg))
 
-    def _get_target(self, flags):
-        self._debug(" Resolving target for flags '{}'".format(str(flags)))
+    def flag_signature(self, target_name):
+        """Return the flag names referenced by the expressions of a target
+
+        This covers the expressions in the filesets, depend, parameters,
+        toplevel, vpi, generate and hooks sections used by the target.
+        Flags outside of the signature can't change how the target is
+        evaluated"""
+        try:
+            return self._flag_signatures[target_name]
+        except AttributeError:
+            self._flag_signatures = {}
+        except KeyError:
+            pass
+
+        target = self.targets.get(target_name)
+        strings = []
+        if target:
+            strings += target.filesets
+            for fs in set().union(*[x.words() for x in target.filesets]):
+                if fs in self.filesets:
+                    strings += self.filesets[fs].depend
+            strings += target.parameters
+            for p in set().union(*[x.words() for x in target.parameters]):
+                p = p.split('=', 1)[0]
+                if p in self.parameters and self.parameters[p].paramtype:
+                    strings.append(self.parameters[p].paramtype)
+            strings += target.toplevel or []
+            strings += target.vpi
+            strings += target.generate
+            if target.hooks:
+                for hook in ['pre_build', 'post_build', 'pre_run', 'post_run']:
+                    strings += getattr(target.hooks, hook) or []
+        signature = frozenset().union(*[x.conditions() for x in strings])
+        self._flag_signatures[target_name] = signature
+        return signature
+
+    def flags_key(self, flags):
+        """Return a hashable key for flags, reduced to the selected target
+        and the flags referenced by its expressions. Flag sets with the
+        same key evaluate the target identically. Note that the tool
+        options are selected directly from the tool flag"""
+        target_name = self._get_target_name(flags)
+        if not target_name in self.targets:
+            return (None, frozenset())
+        return (target_name,
+                frozen_flags(flags) & self.flag_signature(target_name))
+
+    def resolve(self, flags):
+        """Return a ResolvedTarget for flags
+
+        The result is cached for flags with the same flags_key and tool,
+        so the expressions of the target are only evaluated once"""
+        key = (self.flags_key(flags), flags.get('tool'))
+        try:
+            return self._resolved[key]
+        except AttributeError:
+            self._resolved = {}
+        except KeyError:
+            pass
 
-        target_name = None
+        target = self._get_target(flags)
+        filesets = self._get_filesets(flags)
+        resolved = ResolvedTarget(
+            target       = target.name if target else None,
+            filesets     = tuple(fs.name for fs in filesets),
+            files        = tuple(f for fs in filesets for f in fs.files),
+            depends      = tuple(self.get_depends(flags)),
+            parameters   = self.get_parameters(flags),
+            tool_options = self.get_tool_options(flags) if flags.get('tool') else {},
+            vpi          = tuple(self.get_vpi(flags)),
+            generate     = tuple(self.get_ttptttg(flags)))
+        self._resolved[key] = resolved
+        return resolved
+
+    def _get_target_name(self, flags):
         if flags.get('is_toplevel') and flags.get('target'):
-            target_name = flags.get('target')
+            return flags.get('target')
         else:
-            target_name = "default"
+            return "default"
+
+    def _get_target(self, flags):
+        self._debug(" Resolving target for flags '{}'", flags)
+
+        target_name = self._get_target_name(flags)
 
         if target_name in self.targets:
-            self._debug(" Matched target {}".format(target_name))
+            self._debug(" Matched target {}", target_name)
             return self.targets[target_name]
         else:
             self._debug("Matched no target")
 
     def _get_filesets(self, flags):
-        self._debug("Getting filesets for flags '{}'".format(str(flags)))
+        self._debug("Getting filesets for flags '{}'", flags)
         target = self._get_target(flags)
         if not target:
             return []
@@ -509,7 +693,7 @@ Targets:
                 raise SyntaxError("{} : Fileset '{}', requested by target '{}', was not found".format(self.name, fs, target.name))
             filesets.append(self.filesets[fs])
 
-        self._debug(" Matched filesets {}".format(target.filesets))
+        self._debug(" Matched filesets {}", target.filesets)
         return filesets
 
     def _parse_list(self, flags, l):
@@ -757,7 +941,7 @@ def _generate_classes(j, base_class):
         generatedClass = type(cls, (base_class,), class_members)
         globals()[generatedClass.__name__] = generatedClass
 
-capi2_data = yaml.safe_load(description)
+capi2_data = utils.yaml_load(description)
 
 for backend in get_edatools():
     backend_name = backend.__name__
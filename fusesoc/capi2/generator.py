@@ -1,5 +1,6 @@
 import sys
-import yaml
+
+from fusesoc.utils import yaml_dump, yaml_fread
 
 class Generator(object):
     filesets   = {}
@@ -7,8 +8,7 @@ class Generator(object):
     targets    = {}
     def __init__(self, data=None):
         if data is None:
-            with open(sys.argv[1]) as f:
-                data = yaml.safe_load(f)
+            data = yaml_fread(sys.argv[1])
 
         self.config     = data.get('parameters')
         self.files_root = data.get('files_root')
@@ -49,4 +49,4 @@ class Generator(object):
                 'parameters' : self.parameters,
                 'targets'    : self.targets,
             }
-            f.write(yaml.dump(coredata))
+            f.write(yaml_dump(coredata))
@@ -13,6 +13,7 @@ import os
 import importlib
 
 from fusesoc.librarymanager import Library
+from fusesoc.utils import EXPORT_MODES
 
 logger = logging.getLogger(__name__)
 
@@ -25,6 +26,10 @@ class Config(object):
         systems_root = []
         self.library_root = None
         self.libraries = []
+        self.jobs = 1
+        self.export_mode = 'copy'
+        self.lockfile = None
+        self.update_lockfile = False
 
         config = CP()
         if file is None:
@@ -55,7 +60,7 @@ class Config(object):
             file.seek(0)
             self._path = file.name
 
-        for item in ['build_root', 'cache_root', 'systems_root', 'library_root']:
+        for item in ['build_root', 'cache_root', 'systems_root', 'library_root', 'lockfile']:
             try:
                 setattr(self, item, os.path.expanduser(config.get('main', item)))
                 if item == 'systems_root':
@@ -74,6 +79,22 @@ class Config(object):
         except configparser.NoSectionError:
             pass
 
+        try:
+            self.jobs = config.getint('main', 'jobs')
+        except (configparser.NoOptionError, configparser.NoSectionError):
+            pass
+        except ValueError as e:
+            logger.warn("Error parsing jobs '{}'. Using {}".format(str(e), self.jobs))
+
+        try:
+            export_mode = config.get('main', 'export_mode')
+            if export_mode in EXPORT_MODES:
+                self.export_mode = export_mode
+            else:
+                logger.warn("Invalid export_mode '{}'. Using {}".format(export_mode, self.export_mode))
+        except (configparser.NoOptionError, configparser.NoSectionError):
+            pass
+
         #Set fallback values
         if self.build_root is None:
             self.build_root   = os.path.abspath('build')
@@ -83,6 +104,8 @@ class Config(object):
             self.cache_root = os.path.join(xdg_cache_home, 'fusesoc')
             if not os.path.exists(self.cache_root):
                 os.makedirs(self.cache_root)
+        if self.lockfile is None and os.path.exists('fusesoc.lock'):
+            self.lockfile = os.path.abspath('fusesoc.lock')
         if not cores_root and os.path.exists('cores'):
             cores_root   = [os.path.abspath('cores')]
         if (not systems_root) and os.path.exists('systems'):
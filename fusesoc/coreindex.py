@@ -0,0 +1,142 @@
+import hashlib
+import json
+import logging
+import os
+import pickle
+import sys
+
+import fusesoc
+from fusesoc import __version__
+
+logger = logging.getLogger(__name__)
+
+#Bump this when the layout of the index files changes
+INDEX_FORMAT = 1
+
+def _fusesoc_signature():
+    #The parsed cores are only valid for the FuseSoC code (and CAPI
+    #schemas) that created them. Use the version together with the
+    #stat info of all FuseSoC modules so that development checkouts,
+    #where the version is unknown, are invalidated too. The CAPI2 schema
+    #is included since the available tool sections depend on edalize
+    from fusesoc.capi2.core import capi2_data
+
+    h = hashlib.sha1()
+    h.update(str(INDEX_FORMAT).encode())
+    h.update(__version__.encode())
+    h.update(sys.version.encode())
+    h.update(json.dumps(capi2_data, sort_keys=True).encode())
+    pkg_root = os.path.dirname(os.path.abspath(fusesoc.__file__))
+    for root, dirs, files in sorted(os.walk(pkg_root)):
+        for f in sorted(files):
+            if f.endswith('.py'):
+                st = os.stat(os.path.join(root, f))
+                h.update("{}:{}:{}".format(os.path.relpath(os.path.join(root, f), pkg_root),
+                                           st.st_mtime,
+                                           st.st_size).encode())
+    return h.hexdigest()
+
+def _stat_key(path):
+    st = os.stat(path)
+    return (st.st_mtime, st.st_size, st.st_ino)
+
+class CoreIndex(object):
+    """Persistent index of parsed cores in a library
+
+    The index maps each core file to the stat info (mtime, size and
+    inode) it had when it was parsed and the resulting core object, so
+    that unchanged core files don't have to be parsed again"""
+
+    _signature = None
+
+    def __init__(self, cache_root, location):
+        self.location = os.path.abspath(location)
+        _hash = hashlib.sha1(self.location.encode()).hexdigest()
+        self.index_file = os.path.join(cache_root, 'index', _hash + '.pickle')
+        self._entries = {}
+        self._new_entries = {}
+        self._fingerprints = {}
+        self._dirty = False
+
+    @classmethod
+    def signature(cls):
+        if cls._signature is None:
+            cls._signature = _fusesoc_signature()
+        return cls._signature
+
+    def fingerprint(self, core_file):
+        """Return the stat info used to detect changes to a core file"""
+        try:
+            return self._fingerprints[core_file]
+        except KeyError:
+            pass
+        #CAPI1 cores pull in options from an optional .system file
+        system_file = core_file[:-len('.core')] + '.system'
+        if os.path.exists(system_file):
+            system_key = _stat_key(system_file)
+        else:
+            system_key = None
+        key = (_stat_key(core_file), system_key)
+        self._fingerprints[core_file] = key
+        return key
+
+    def load(self):
+        if not os.path.exists(self.index_file):
+            return
+        try:
+            with open(self.index_file, 'rb') as f:
+                data = pickle.load(f)
+        except Exception as e:
+            logger.debug("Ignoring unreadable core index {} : {}".format(self.index_file, str(e)))
+            return
+        if data.get('signature') != self.signature():
+            logger.debug("Ignoring outdated core index " + self.index_file)
+            self._dirty = True
+            return
+        self._entries = data['cores']
+
+    def get(self, core_file):
+        try:
+            key = self.fingerprint(core_file)
+        except OSError:
+            return None
+        entry = self._entries.get(core_file)
+        if entry and entry[0] == key:
+            self._new_entries[core_file] = entry
+            return entry[1]
+        self._dirty = True
+        return None
+
+    def add(self, core_file, core):
+        self._new_entries[core_file] = (self.fingerprint(core_file), core)
+        self._dirty = True
+
+    def save(self):
+        #Only keep the cores found in this scan, so that removed
+        #files are dropped from the index
+        if not self._dirty and (len(self._new_entries) == len(self._entries)):
+            return
+        data = {'signature' : self.signature(),
+                'location'  : self.location,
+                'cores'     : self._new_entries}
+        index_dir = os.path.dirname(self.index_file)
+        tmp_file = self.index_file + '.' + str(os.getpid())
+        try:
+            if not os.path.exists(index_dir):
+                os.makedirs(index_dir)
+            with open(tmp_file, 'wb') as f:
+                pickle.dump(data, f, pickle.HIGHEST_PROTOCOL)
+            try:
+                os.rename(tmp_file, self.index_file)
+            except OSError:
+                #Windows refuses to rename over an existing file
+                os.remove(self.index_file)
+                os.rename(tmp_file, self.index_file)
+        except (IOError, OSError, pickle.PicklingError) as e:
+            logger.warning("Failed to write core index {} : {}".format(self.index_file, str(e)))
+            if os.path.exists(tmp_file):
+                os.remove(tmp_file)
+        self._entries = self._new_entries
+        self._new_entries = {}
+        self._fingerprints = {}
+        self._dirty = False
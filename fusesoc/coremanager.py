@@ -1,17 +1,11 @@
+import bisect
+import hashlib
 import logging
 import os
 
-from okonomiyaki.versions import EnpkgVersion
-
-from simplesat.constraints import PrettyPackageStringParser, Requirement
-from simplesat.dependency_solver import DependencySolver
-from simplesat.errors import NoPackageFound, SatisfiabilityError
-from simplesat.pool import Pool
-from simplesat.repository import Repository
-from simplesat.request import Request
-
-from fusesoc.core import Core
+from fusesoc.coreindex import CoreIndex
 from fusesoc.librarymanager import LibraryManager
+from fusesoc.lockfile import LockFile, ResolutionCache, _normalize_flags
 
 logger = logging.getLogger(__name__)
 
@@ -22,9 +16,49 @@ class DependencyError(Exception):
     def __str__(self):
         return repr(self.value)
 
+_enpkg_versions = {}
+
+def _enpkg_version(vlnv):
+    #Version objects for the solver. These are immutable, so they are
+    #shared between all cores with the same version
+    key = (vlnv.version, vlnv.revision)
+    try:
+        return _enpkg_versions[key]
+    except KeyError:
+        pass
+    from okonomiyaki.errors import InvalidVersion
+    from okonomiyaki.versions import EnpkgVersion
+    try:
+        version = EnpkgVersion.from_string("{}-{}".format(vlnv.version,
+                                                          vlnv.revision))
+    except InvalidVersion as e:
+        raise ValueError(str(e))
+    _enpkg_versions[key] = version
+    return version
+
+_RELATIONS = {
+    '==' : lambda version, required : version == required,
+    '>=' : lambda version, required : version >= required,
+    '>'  : lambda version, required : version >  required,
+    '<=' : lambda version, required : version <= required,
+    '<'  : lambda version, required : version <  required,
+}
+
 class CoreDB(object):
     def __init__(self):
         self._cores = {}
+        #Maps package names to the names of all cores with that package name
+        self._packages = {}
+        #Maps (vendor, library, name) to a list of (version key, core name),
+        #sorted by version
+        self._versions = {}
+        #Maps core names to their version keys
+        self._core_versions = {}
+        self._fingerprints = {}
+        self._content_hash = None
+        #Dependencies of cores, shared between flag sets that evaluate a
+        #core identically
+        self._depends = {}
 
     #simplesat doesn't allow ':', '-' or leading '_'
     def _package_name(self, vlnv):
@@ -37,72 +71,241 @@ class CoreDB(object):
         return "{}-{}".format(vlnv.version,
                               vlnv.revision)
 
-    def _parse_depend(self, depends):
+    def _install_requires(self, depends):
         #FIXME: Handle conflicts
-        deps = []
-        _s = "{} {} {}"
+        #Constraints on the same package are combined into one requirement
+        constraints = {}
+        names = []
         for d in depends:
-            deps.append(_s.format(self._package_name(d),
-                                  d.relation,
-                                  self._package_version(d)))
-        return ", ".join(deps)
+            name = self._package_name(d)
+            if not name in constraints:
+                constraints[name] = []
+                names.append(name)
+            constraints[name].append("{} {}".format(d.relation,
+                                                    self._package_version(d)))
+        return tuple((name, (tuple(constraints[name]),)) for name in names)
 
-    def add(self, core, library):
+    def add(self, core, library, fingerprint=None):
         name = str(core.name)
-        logger.debug("Adding core " + name)
+        debug = logger.isEnabledFor(logging.DEBUG)
+        if debug:
+            logger.debug("Adding core " + name)
         if name in self._cores:
-            _s = "Replacing {} in {} with the version found in {}"
-            logger.debug(_s.format(name,
-                                   self._cores[name]['core'].core_root,
-                                   core.core_root))
+            if debug:
+                _s = "Replacing {} in {} with the version found in {}"
+                logger.debug(_s.format(name,
+                                       self._cores[name]['core'].core_root,
+                                       core.core_root))
+        else:
+            package_name = self._package_name(core.name)
+            self._packages.setdefault(package_name, []).append(name)
+            version = core.name.version_key
+            if version is None:
+                logger.warning("Invalid version for core {} : {}".format(name, core.name.version))
+            else:
+                self._core_versions[name] = version
+                key = (core.name.vendor, core.name.library, core.name.name)
+                bisect.insort(self._versions.setdefault(key, []),
+                              (version, name))
         self._cores[name] = {'core' : core, 'library' : library}
+        self._fingerprints[name] = fingerprint
+        self._content_hash = None
+        self._depends = {}
+
+    def content_hash(self):
+        """Return a hash identifying the cores in the database and the
+        state of their core files, or None if that can't be determined"""
+        if self._content_hash is None:
+            h = hashlib.sha1()
+            for name in sorted(self._cores):
+                fingerprint = self._fingerprints[name]
+                if fingerprint is None:
+                    return None
+                h.update("{}:{}:{}\n".format(name,
+                                             self._cores[name]['core'].core_file,
+                                             repr(fingerprint)).encode('utf-8'))
+            self._content_hash = h.hexdigest()
+        return self._content_hash
+
+    def _get_depends(self, core, flags):
+        if not hasattr(core, 'flags_key'):
+            return core.get_depends(flags)
+        key = (str(core.name), bool(flags.get('is_toplevel')), core.flags_key(flags))
+        try:
+            return self._depends[key]
+        except KeyError:
+            depends = core.get_depends(flags)
+            self._depends[key] = depends
+            return depends
+
+    def get_cores(self, names):
+        """Return the cores with the given names or None if any of them
+        is missing"""
+        try:
+            return [self._cores[name]['core'] for name in names]
+        except KeyError:
+            return None
+
+    def _get_reachable(self, top_core, flags):
+        #Find all cores that can be reached from top_core, considering
+        #every version of each dependency. Returns the dependencies of
+        #each reachable core
+        _flags = flags.copy()
+        depends = {}
+        visited = set()
+        queue = [self._package_name(top_core)]
+        while queue:
+            package_name = queue.pop()
+            if package_name in visited:
+                continue
+            visited.add(package_name)
+            for name in self._packages.get(package_name, []):
+                core = self._cores[name]['core']
+                _flags['is_toplevel'] = (core.name == top_core)
+                _depends = self._get_depends(core, _flags)
+                depends[name] = _depends
+                queue += [self._package_name(d) for d in _depends]
+        return depends
 
     def find(self, vlnv=None):
         if vlnv:
-            found = self._solve(vlnv, only_matching_vlnv=True)[-1]
+            found = self._find(vlnv)
         else:
             found = list([core['core'] for core in self._cores.values()])
         return found
 
-    def solve(self, top_core, flags):
-        return self._solve(top_core, flags)
+    def _find(self, vlnv):
+        #Pick the latest version matching the relation in vlnv
+        key = (vlnv.vendor, vlnv.library, vlnv.name)
+        if not vlnv.relation in _RELATIONS:
+            raise DependencyError(vlnv.name,
+                                  msg="Unknown relation '{}'".format(vlnv.relation))
+        match = _RELATIONS[vlnv.relation]
+        required = vlnv.version_key
+        if required is None:
+            raise DependencyError(vlnv.name,
+                                  msg="Invalid version '{}'".format(vlnv.version))
+        for version, name in reversed(self._versions.get(key, [])):
+            if match(version, required):
+                return self._cores[name]['core']
+        raise DependencyError(vlnv.name)
 
-    def _solve(self, top_core, flags={}, only_matching_vlnv=False):
-        def eq_vln(this, that):
-            return \
-                this.vendor  == that.vendor and \
-                this.library == that.library and \
-                this.name    == that.name
+    def solve(self, top_core, flags):
+        resolved = self._resolve_greedy(top_core, flags)
+        if resolved is None:
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug("Falling back to SAT solver for " + str(top_core))
+            resolved = self._solve(top_core, flags)
+        return resolved
 
-        repo = Repository()
+    def _resolve_greedy(self, top_core, flags):
+        #Pick the latest version of each package that satisfies the first
+        #requirement on it and check that all later requirements are met
+        #by that version. Returns None whenever this doesn't give a clear
+        #answer, in which case the SAT solver has to be used instead.
+        #The result is ordered the same way as the solver transaction.
+        #Without conflicts this usually gives the same cores as the
+        #solver, but when several sets of versions are valid, the solver
+        #doesn't always pick the latest versions and the results differ
         _flags = flags.copy()
-        cores = [x['core'] for x in self._cores.values()]
-        for core in cores:
-            if only_matching_vlnv:
-                if not eq_vln(core.name, top_core):
+        selected = {}
+        depends = {}
+        queue = [top_core]
+        while queue:
+            dep = queue.pop(0)
+            package_name = self._package_name(dep)
+            if not dep.relation in _RELATIONS:
+                return None
+            match = _RELATIONS[dep.relation]
+            required = dep.version_key
+            if required is None:
+                return None
+
+            if package_name in selected:
+                if not match(self._core_versions[selected[package_name]], required):
+                    return None
+                continue
+
+            best = None
+            for name in self._packages.get(package_name, []):
+                version = self._core_versions.get(name)
+                if version is None:
+                    return None
+                if not match(version, required):
                     continue
+                if best and version == best[0]:
+                    return None
+                if not best or version > best[0]:
+                    best = (version, name)
+            if not best:
+                return None
 
-            package_str = "{} {}-{}".format(self._package_name(core.name),
-                                            core.name.version,
-                                            core.name.revision)
-            if not only_matching_vlnv:
-                _flags['is_toplevel'] = (core.name == top_core)
-                _depends = core.get_depends(_flags)
-                if _depends:
-                    _s = "; depends ( {} )"
-                    package_str += _s.format(self._parse_depend(_depends))
-            parser = PrettyPackageStringParser(EnpkgVersion.from_string)
+            name = best[1]
+            selected[package_name] = name
+            core = self._cores[name]['core']
+            _flags['is_toplevel'] = (core.name == top_core)
+            depends[package_name] = self._get_depends(core, _flags)
+            queue += depends[package_name]
+
+        top_package = self._package_name(top_core)
+        edges = {}
+        for package_name, _depends in depends.items():
+            edges[package_name] = set(self._package_name(d) for d in _depends)
+            edges[package_name].discard(package_name)
+            #Other versions of the top core are part of the solver's
+            #dependency graph, so the order can't be reproduced here
+            if top_package in edges[package_name]:
+                return None
 
-            package = parser.parse_to_package(package_str)
+        #Group the packages bottom-up like the solver does. Packages in a
+        #group are ordered by name, which is the order the solver
+        #assigns ids in
+        ordered = []
+        while edges:
+            group = sorted(p for (p, e) in edges.items() if not e)
+            if not group:
+                return None
+            ordered += group
+            edges = {p : e.difference(group) for (p, e) in edges.items() if e}
+        return [self._cores[selected[p]]['core'] for p in ordered]
+
+    def _solve(self, top_core, flags={}):
+        from simplesat.constraints import Requirement
+        from simplesat.constraints.kinds import Equal, GEQ, GT, LEQ, LT
+        from simplesat.dependency_solver import DependencySolver
+        from simplesat.errors import NoPackageFound, SatisfiabilityError
+        from simplesat.package import PackageMetadata
+        from simplesat.pool import Pool
+        from simplesat.repository import Repository
+        from simplesat.request import Request
+
+        constraint_kinds = {'==' : Equal,
+                            '>=' : GEQ,
+                            '>'  : GT,
+                            '<=' : LEQ,
+                            '<'  : LT}
+
+        repo = Repository()
+        #Only the cores reachable from the top core can be part of
+        #the solution, so don't hand anything else to the solver
+        reachable = self._get_reachable(top_core, flags)
+        for (name, x) in self._cores.items():
+            if not name in reachable:
+                continue
+            core = x['core']
+            package = PackageMetadata(self._package_name(core.name),
+                                      _enpkg_version(core.name),
+                                      self._install_requires(reachable[name]))
             package.core = core
 
             repo.add_package(package)
 
         request = Request()
-        _top_dep = "{} {} {}".format(self._package_name(top_core),
-                                     top_core.relation,
-                                     self._package_version(top_core))
-        requirement = Requirement._from_string(_top_dep)
+        if not top_core.relation in constraint_kinds:
+            raise DependencyError(top_core.name,
+                                  msg="Unknown relation '{}'".format(top_core.relation))
+        constraint = constraint_kinds[top_core.relation](_enpkg_version(top_core))
+        requirement = Requirement(self._package_name(top_core), [constraint])
         request.install(requirement)
         installed_repository = Repository()
         pool = Pool([repo])
@@ -119,34 +322,89 @@ class CoreDB(object):
 
         return [op.package.core for op in transaction.operations]
 
+def _parse_core(args):
+    #Module-level so that it can be called from a process pool
+    from fusesoc.core import Core
+
+    core_file, cache_root = args
+    try:
+        return (Core(core_file, cache_root), None)
+    except SyntaxError as e:
+        return (None, "Parse error. Ignoring file " + core_file + ": " + e.msg)
+    except ImportError as e:
+        w = 'Failed to register "{}" due to unknown provider: {}'
+        return (None, w.format(core_file, str(e)))
+
 class CoreManager(object):
 
     def __init__(self, config):
         self.config = config
-        self.db = CoreDB()
+        self._db = CoreDB()
         self._lm = LibraryManager(config.library_root)
+        self._pending_libraries = []
+        self._resolution_cache = ResolutionCache(config.cache_root)
+        self._lockfile = None
+
+    @property
+    def db(self):
+        #Libraries are scanned on first use, so that commands which
+        #don't need any cores don't pay for it
+        while self._pending_libraries:
+            library = self._pending_libraries.pop(0)
+            try:
+                self.load_cores(library)
+            except IOError as e:
+                _s = "Failed to register library '{}'"
+                logger.warning(_s.format(str(e)))
+        return self._db
 
     def load_cores(self, library):
         path = os.path.expanduser(library.location)
         if os.path.isdir(path) == False:
             raise IOError(path + " is not a directory")
         logger.debug("Checking for cores in " + path)
+        db = self._db
+        index = CoreIndex(self.config.cache_root, path)
+        index.load()
+        core_files = []
         for root, dirs, files in os.walk(path, followlinks=True):
             if 'FUSESOC_IGNORE' in files:
                 del dirs[:]
                 continue
             for f in files:
                 if f.endswith('.core'):
-                    core_file = os.path.join(root, f)
-                    try:
-                        core = Core(core_file, self.config.cache_root)
-                        self.db.add(core, library)
-                    except SyntaxError as e:
-                        w = "Parse error. Ignoring file " + core_file + ": " + e.msg
-                        logger.warning(w)
-                    except ImportError as e:
-                        w = 'Failed to register "{}" due to unknown provider: {}'
-                        logger.warning(w.format(core_file, str(e)))
+                    core_files.append(os.path.join(root, f))
+
+        cores = [index.get(core_file) for core_file in core_files]
+        unparsed = [f for (f, c) in zip(core_files, cores) if c is None]
+
+        jobs = min(self.config.jobs, len(unparsed))
+        if jobs > 1:
+            import multiprocessing
+
+            logger.debug("Parsing {} core files using {} processes".format(len(unparsed), jobs))
+            pool = multiprocessing.Pool(jobs)
+            try:
+                results = pool.map(_parse_core,
+                                   [(f, self.config.cache_root) for f in unparsed])
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            results = [_parse_core((f, self.config.cache_root)) for f in unparsed]
+        parsed = dict(zip(unparsed, results))
+
+        #Add cores in the order they were found to keep the
+        #last-added-wins behavior of CoreDB
+        for core_file, core in zip(core_files, cores):
+            if core is None:
+                core, warning = parsed[core_file]
+                if warning:
+                    logger.warning(warning)
+                    continue
+                index.add(core_file, core)
+            db.add(core, library, index.fingerprint(core_file))
+        index.save()
 
     def add_library(self, library):
         abspath = os.path.abspath(os.path.expanduser(library.location))
@@ -158,20 +416,72 @@ class CoreManager(object):
                                   _library.name))
             return
 
-        self.load_cores(library)
+        path = os.path.expanduser(library.location)
+        if not os.path.isdir(path):
+            raise IOError(path + " is not a directory")
+        self._pending_libraries.append(library)
         self._lm.add_library(library)
 
     def get_libraries(self):
         return self._lm.get_libraries()
 
+    def _get_lockfile(self):
+        if self._lockfile is None and self.config.lockfile:
+            self._lockfile = LockFile(self.config.lockfile)
+        return self._lockfile
+
     def get_depends(self, core, flags):
-        logger.debug("Calculating dependencies for {}{} with flags {}".format(core.relation,str(core), str(flags)))
+        debug = logger.isEnabledFor(logging.DEBUG)
+        if debug:
+            logger.debug("Calculating dependencies for {}{} with flags {}".format(core.relation,str(core), str(flags)))
         resolved_core = self.db.find(core)
-        deps = self.db.solve(resolved_core.name, flags)
-        logger.debug(" Resolved core to {}".format(str(resolved_core.name)))
-        logger.debug(" with dependencies " + ', '.join([str(c.name) for c in deps]))
+        if debug:
+            logger.debug(" Resolved core to {}".format(str(resolved_core.name)))
+        top = resolved_core.name
+
+        lockfile = self._get_lockfile()
+        deps = None
+        if lockfile and not self.config.update_lockfile:
+            deps = lockfile.get(top, flags, self.db)
+            if deps is not None:
+                logger.debug(" Using dependencies from " + lockfile.path)
+
+        content_hash = self.db.content_hash()
+        if deps is None:
+            deps = self.db.get_cores(self._resolution_cache.get(top, flags, content_hash) or [])
+            if deps:
+                logger.debug(" Using cached dependencies")
+            else:
+                deps = self.db.solve(top, flags)
+                self._resolution_cache.set(top, flags, content_hash,
+                                           [str(c.name) for c in deps])
+
+        if lockfile and self.config.update_lockfile:
+            lockfile.set(top, flags, deps)
+            lockfile.save()
+        if debug:
+            logger.debug(" with dependencies " + ', '.join([str(c.name) for c in deps]))
         return deps
 
+    def get_depends_many(self, core, flags_list):
+        """Resolve the dependencies of a core for several sets of flags
+
+        The parsed cores and the dependencies of each core are shared
+        between the flag sets, and identical flag sets are only resolved
+        once. Returns a (dependencies, error) tuple for each set of flags,
+        where error is the DependencyError raised for that set or None"""
+        results = []
+        resolved = {}
+        for flags in flags_list:
+            key = tuple(sorted(_normalize_flags(flags).items()))
+            if not key in resolved:
+                try:
+                    resolved[key] = (self.get_depends(core, flags), None)
+                except DependencyError as e:
+                    resolved[key] = (None, e)
+            results.append(resolved[key])
+        return results
+
     def get_cores(self):
         return {str(x.name) : x for x in self.db.find()}
 
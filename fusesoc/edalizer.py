@@ -1,36 +1,32 @@
+import hashlib
+import itertools
+import json
 import logging
 import os
 import shutil
-import yaml
+import time
 
+from fusesoc import __version__
+from fusesoc.utils import yaml_dump, yaml_fwrite, yaml_load
 from fusesoc.vlnv import Vlnv
 
 logger = logging.getLogger(__name__)
 
 class Edalizer(object):
 
-    def __init__(self, vlnv, flags, cores, cache_root, work_root, export_root=None, system_name=None):
-        if os.path.exists(work_root):
-            for f in os.listdir(work_root):
-                if os.path.isdir(os.path.join(work_root, f)):
-                    shutil.rmtree(os.path.join(work_root, f))
-                else:
-                    os.remove(os.path.join(work_root, f))
-        else:
-            os.makedirs(work_root)
+    def __init__(self, vlnv, flags, cores, cache_root, work_root, export_root=None, system_name=None, jobs=1, export_mode='copy'):
+        self.work_root = work_root
 
-        logger.debug("Building EDA API")
-        def merge_dict(d1, d2):
-            for key, value in d2.items():
-                if isinstance(value, dict):
-                    d1[key] = merge_dict(d1.get(key, {}), value)
-                elif isinstance(value, list):
-                    d1[key] = d1.get(key, []) + value
-                else:
-                    d1[key] = value
-            return d1
+        #Fetch the remote cores up front, so that the downloads can run
+        #concurrently. Generated cores don't exist yet and are set up
+        #when they are reached in the core queue
+        setup_cores(cores, jobs)
+        fetched = set(id(core) for core in cores)
 
+        logger.debug("Building EDA API")
         generators   = {}
+        copied_files = []
+        used_cores   = []
 
         first_snippets = []
         snippets       = []
@@ -41,40 +37,41 @@ class Edalizer(object):
         while core_queue:
             snippet = {}
             core = core_queue.pop()
+            used_cores.append(core)
             logger.info("Preparing " + str(core.name))
-            core.setup()
+            if not id(core) in fetched:
+                core.setup()
 
-            logger.debug("Collecting EDA API parameters from {}".format(str(core.name)))
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug("Collecting EDA API parameters from {}".format(str(core.name)))
             _flags['is_toplevel'] = (core.name == vlnv)
 
             #Extract files
             if export_root:
                 files_root = os.path.join(export_root, core.sanitized_name)
-                core.export(files_root, _flags)
+                core.export(files_root, _flags, export_mode)
             else:
                 files_root = core.files_root
 
             rel_root = os.path.relpath(files_root, work_root)
 
+            resolved = _resolve(core, _flags)
+
             #Extract parameters
-            snippet['parameters'] = core.get_parameters(_flags)
+            snippet['parameters'] = resolved.parameters
 
             #Extract tool options
-            snippet['tool_options'] = {flags['tool'] : core.get_tool_options(_flags)}
+            snippet['tool_options'] = {flags['tool'] : resolved.tool_options}
 
             #Extract scripts
             snippet['hooks'] = core.get_scripts(rel_root, _flags)
 
             _files = []
-            for file in core.get_files(_flags):
+            for file in resolved.files:
                 if file.copyto:
                     _name = file.copyto
-                    dst = os.path.join(work_root, _name)
-                    _dstdir = os.path.dirname(dst)
-                    if not os.path.exists(_dstdir):
-                        os.makedirs(_dstdir)
-                    shutil.copy2(os.path.join(files_root, file.name),
-                                 dst)
+                    copied_files.append((os.path.join(files_root, file.name),
+                                         os.path.join(work_root, _name)))
                 else:
                     _name = os.path.join(rel_root, file.name)
                 _files.append({
@@ -87,7 +84,7 @@ class Edalizer(object):
 
             #Extract VPI modules
             snippet['vpi'] = []
-            for _vpi in core.get_vpi(_flags):
+            for _vpi in resolved.vpi:
                 snippet['vpi'].append({'name'         : _vpi['name'],
                                        'src_files'    : [os.path.join(rel_root, f) for f in _vpi['src_files']],
                                        'include_dirs' : [os.path.join(rel_root, i) for i in _vpi['include_dirs']],
@@ -98,12 +95,11 @@ class Edalizer(object):
                 generators.update(core.get_generators(_flags))
 
             #Run generators
-            if hasattr(core, 'get_ttptttg'):
-                for ttptttg_data in core.get_ttptttg(_flags):
-                    _ttptttg = Ttptttg(ttptttg_data, core, generators)
-                    for gen_core in _ttptttg.generate(cache_root):
-                        gen_core.pos = _ttptttg.pos
-                        core_queue.append(gen_core)
+            for ttptttg_data in resolved.generate:
+                _ttptttg = Ttptttg(ttptttg_data, core, generators)
+                for gen_core in _ttptttg.generate(cache_root):
+                    gen_core.pos = _ttptttg.pos
+                    core_queue.append(gen_core)
 
             if hasattr(core, 'pos'):
                 if core.pos == 'first':
@@ -127,16 +123,257 @@ class Edalizer(object):
             'vpi'          : [],
         }
 
-        for snippet in first_snippets + snippets + last_snippets:
-            merge_dict(self.edalize, snippet)
+        _merge_snippets(self.edalize, first_snippets + snippets + last_snippets)
 
-    def to_yaml(self, edalize_file):
-        with open(edalize_file,'w') as f:
-            f.write(yaml.dump(self.edalize))
+        #The work root is kept as it is if nothing has changed since the
+        #last run, so that the EDA tools can rebuild incrementally
+        self.input_hash = _input_hash(self.edalize, flags, used_cores, copied_files)
+        stamp = self._read_stamp()
+        self.unchanged = bool(stamp) and stamp.get('input_hash') == self.input_hash
+        if self.unchanged:
+            logger.info("EDA API inputs unchanged. Keeping " + work_root)
+            return
+
+        if os.path.exists(work_root):
+            for f in os.listdir(work_root):
+                if os.path.isdir(os.path.join(work_root, f)):
+                    shutil.rmtree(os.path.join(work_root, f))
+                else:
+                    os.remove(os.path.join(work_root, f))
+        else:
+            os.makedirs(work_root)
 
+        for src, dst in copied_files:
+            _dstdir = os.path.dirname(dst)
+            if not os.path.exists(_dstdir):
+                os.makedirs(_dstdir)
+            shutil.copy2(src, dst)
+
+    def _stamp_file(self):
+        return os.path.join(self.work_root, EDALIZER_STAMP)
+
+    def _read_stamp(self):
+        try:
+            with open(self._stamp_file()) as f:
+                return json.load(f)
+        except (IOError, OSError, ValueError):
+            return None
+
+    def is_configured(self, backendargs):
+        """Return True if the work root was configured with the same
+        inputs and backend arguments before"""
+        if not self.unchanged:
+            return False
+        stamp = self._read_stamp()
+        return bool(stamp) and stamp.get('backendargs') == list(backendargs or [])
+
+    def set_configured(self, backendargs):
+        """Record that the work root was configured with backendargs, or
+        clear the record if backendargs is None"""
+        stamp_file = self._stamp_file()
+        if backendargs is None:
+            if os.path.exists(stamp_file):
+                os.remove(stamp_file)
+            return
+        with open(stamp_file, 'w') as f:
+            json.dump({'input_hash'  : self.input_hash,
+                       'backendargs' : list(backendargs)}, f)
+
+    def to_yaml(self, edalize_file):
+        if self.unchanged and os.path.exists(edalize_file):
+            return
+        with open(edalize_file, 'w') as f:
+            yaml_sha1 = _write_edam(f, self.edalize)
+        _write_sidecar(edalize_file, yaml_sha1, self.edalize)
+
+def setup_cores(cores, jobs=1, progress=None):
+    #Run setup() on all cores, fetching up to jobs remote cores at a time.
+    #The fetches mostly wait for the network or for external tools, so
+    #threads are enough to run them concurrently. progress is called from
+    #the calling thread with each core, the time its setup took and the
+    #RuntimeError it raised, if any, as the fetches finish
+    def setup(core):
+        start = time.time()
+        try:
+            core.setup()
+            error = None
+        except RuntimeError as e:
+            error = e
+        return core, time.time() - start, error
+
+    remote = [core for core in cores if getattr(core, 'provider', None)]
+    jobs = min(jobs, len(remote))
+    if jobs > 1:
+        from multiprocessing.pool import ThreadPool
+
+        logger.debug("Fetching {} cores using {} threads".format(len(remote), jobs))
+        pool = ThreadPool(jobs)
+        results = pool.imap_unordered(setup, remote)
+    else:
+        pool = None
+        results = (setup(core) for core in remote)
+    try:
+        for core, seconds, error in results:
+            if progress:
+                progress(core, seconds, error)
+            if error:
+                raise error
+    finally:
+        if pool:
+            pool.terminate()
+            pool.join()
+
+def _merge_snippets(d, snippets):
+    #Merge snippets into d in order. Dicts are merged recursively, lists
+    #are concatenated and other values are replaced. The lists from all
+    #snippets are collected first and concatenated once, since growing
+    #the lists snippet by snippet is quadratic in the number of items
+    keys = []
+    values = {}
+    for snippet in snippets:
+        for key, value in snippet.items():
+            if isinstance(value, (dict, list)):
+                if not key in values:
+                    keys.append(key)
+                    values[key] = []
+                values[key].append(value)
+            else:
+                d[key] = value
+    for key in keys:
+        if isinstance(values[key][0], dict):
+            d[key] = _merge_snippets(d.get(key, {}), values[key])
+        else:
+            d[key] = list(itertools.chain(d.get(key, []), *values[key]))
+    return d
+
+#Number of list items the EDAM writer serializes at a time
+EDAM_CHUNK_SIZE = 1000
+
+def _write_edam(f, edam):
+    #Write the EDAM as YAML, giving the same output as yaml_dump. Each
+    #section is written on its own and the file lists a chunk at a time,
+    #so the YAML text of the whole EDAM is never held in memory. Returns
+    #the SHA1 of the written text
+    h = hashlib.sha1()
+    def write(data):
+        f.write(data)
+        h.update(data.encode('utf-8'))
+
+    for key in sorted(edam):
+        value = edam[key]
+        if isinstance(value, list) and value:
+            #Top-level sequences are not indented, so the items can be
+            #written as separate sequences after the key
+            write(yaml_dump({key : [0]})[:-len('- 0\n')])
+            for i in range(0, len(value), EDAM_CHUNK_SIZE):
+                write(yaml_dump(value[i:i+EDAM_CHUNK_SIZE]))
+        else:
+            write(yaml_dump({key : value}))
+    return h.hexdigest()
+
+#Written to the work root after a successful configure
+EDALIZER_STAMP = '.fusesoc-edalizer.json'
+
+def _file_hash(path):
+    #Generators rewrite their output files on every run, so the content
+    #is hashed rather than the stat info
+    h = hashlib.sha1()
+    try:
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 16), b''):
+                h.update(block)
+    except (IOError, OSError):
+        return None
+    return h.hexdigest()
+
+def _input_hash(edam, flags, cores, copied_files):
+    #Everything the EDAM and the work root are created from, including
+    #the core files of generated cores
+    data = {'fusesoc' : __version__,
+            'edam'    : edam,
+            'flags'   : sorted((k, str(v)) for k, v in flags.items()),
+            'cores'   : [(str(core.name),
+                          core.core_file,
+                          _file_hash(core.core_file)) for core in cores],
+            'copied'  : [(src, dst, _file_hash(src)) for src, dst in copied_files]}
+    #Hash the JSON text as it is generated to avoid holding all of it.
+    #The encoder yields tiny chunks, so they are hashed in batches
+    h = hashlib.sha1()
+    chunks = []
+    for chunk in json.JSONEncoder(sort_keys=True, default=str).iterencode(data):
+        chunks.append(chunk)
+        if len(chunks) >= 4096:
+            h.update(''.join(chunks).encode('utf-8'))
+            chunks = []
+    h.update(''.join(chunks).encode('utf-8'))
+    return h.hexdigest()
+
+#The EDAM is also stored as JSON next to the YAML file since it is much
+#faster to load. The sidecar records a hash of the YAML file it was
+#written together with and is only used while that file is unchanged
+EDAM_SIDECAR_VERSION = 1
+
+def _sidecar_file(edalize_file):
+    return os.path.splitext(edalize_file)[0] + '.json'
+
+def _yaml_hash(data):
+    return hashlib.sha1(data.encode('utf-8')).hexdigest()
+
+def _write_sidecar(edalize_file, yaml_sha1, edam):
+    sidecar = {'sidecar_version' : EDAM_SIDECAR_VERSION,
+               'yaml_sha1'       : yaml_sha1,
+               'edam'            : edam}
+    try:
+        with open(_sidecar_file(edalize_file), 'w') as f:
+            json.dump(sidecar, f)
+    except (IOError, OSError, TypeError, ValueError) as e:
+        logger.debug("Failed to write EDAM sidecar : " + str(e))
+
+def _read_sidecar(edalize_file, data):
+    sidecar_file = _sidecar_file(edalize_file)
+    if not os.path.exists(sidecar_file):
+        return None
+    if os.path.getmtime(sidecar_file) < os.path.getmtime(edalize_file):
+        logger.debug("Ignoring outdated EDAM sidecar " + sidecar_file)
+        return None
+    try:
+        with open(sidecar_file) as f:
+            sidecar = json.load(f)
+    except (IOError, OSError, ValueError) as e:
+        logger.debug("Ignoring unreadable EDAM sidecar {} : {}".format(sidecar_file, str(e)))
+        return None
+    if sidecar.get('sidecar_version') != EDAM_SIDECAR_VERSION or \
+       sidecar.get('yaml_sha1') != _yaml_hash(data):
+        logger.debug("Ignoring mismatching EDAM sidecar " + sidecar_file)
+        return None
+    return sidecar.get('edam')
+
+def load_edam(edalize_file):
+    """Load an EDAM file, preferring the JSON sidecar when it is valid"""
+    with open(edalize_file) as f:
+        data = f.read()
+    edam = _read_sidecar(edalize_file, data)
+    if edam is None:
+        edam = yaml_load(data)
+    return edam
+
+from fusesoc.capi2.core import ResolvedTarget
 from fusesoc.core import Core
 from fusesoc.utils import Launcher
 
+def _resolve(core, flags):
+    if hasattr(core, 'resolve'):
+        return core.resolve(flags)
+    #CAPI1 cores have no targets or generators
+    return ResolvedTarget(target       = None,
+                          filesets     = (),
+                          files        = tuple(core.get_files(flags)),
+                          depends      = tuple(core.get_depends(flags)),
+                          parameters   = core.get_parameters(flags),
+                          tool_options = core.get_tool_options(flags),
+                          vpi          = tuple(core.get_vpi(flags)),
+                          generate     = ())
+
 class Ttptttg(object):
 
     def __init__(self, ttptttg, core, generators):
@@ -177,8 +414,7 @@ class Ttptttg(object):
         logger.info('Generating ' + str(self.vlnv))
         if not os.path.exists(generator_cwd):
             os.makedirs(generator_cwd)
-        with open(generator_input_file, 'w') as f:
-            f.write(yaml.dump(self.generator_input))
+        yaml_fwrite(generator_input_file, self.generator_input)
 
         args = [os.path.join(os.path.abspath(self.generator.root), self.generator.command),
                 generator_input_file]
@@ -199,5 +435,6 @@ class Ttptttg(object):
                     except SyntaxError as e:
                         w = "Failed to parse generated core file " + f + ": " + e.msg
                         raise RuntimeError(w)
-        logger.debug("Found " + ', '.join(str(c.name) for c in cores))
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Found " + ', '.join(str(c.name) for c in cores))
         return cores
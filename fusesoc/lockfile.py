@@ -0,0 +1,120 @@
+import hashlib
+import json
+import logging
+import os
+
+from fusesoc.coreindex import CoreIndex
+from fusesoc.utils import yaml_fread, yaml_fwrite
+
+logger = logging.getLogger(__name__)
+
+LOCKFILE_VERSION = 1
+
+def _normalize_flags(flags):
+    #Unset flags can't be tested in CAPI2 expressions, so drop them.
+    #is_toplevel is set by the solver for each core
+    return {k : v for k, v in flags.items()
+            if not v in [False, None] and k != 'is_toplevel'}
+
+def _file_hash(path):
+    h = hashlib.sha1()
+    with open(path, 'rb') as f:
+        h.update(f.read())
+    return h.hexdigest()
+
+class ResolutionCache(object):
+    """Persistent cache of dependency resolutions
+
+    Results are stored under <cache_root>/resolve and are keyed on the
+    top core, the flags, the content hash of the core database and the
+    FuseSoC signature, so that any change to the available cores or to
+    FuseSoC itself invalidates them"""
+
+    def __init__(self, cache_root):
+        self.cache_dir = os.path.join(cache_root, 'resolve')
+
+    def _cache_file(self, top_core, flags, content_hash):
+        #All flags are kept in the key. The flags are passed on to every
+        #dependency, so a flag that doesn't affect the top core can still
+        #change which cores the dependencies pull in
+        key = json.dumps([str(top_core),
+                          sorted(_normalize_flags(flags).items()),
+                          content_hash,
+                          CoreIndex.signature()])
+        return os.path.join(self.cache_dir,
+                            hashlib.sha1(key.encode('utf-8')).hexdigest() + '.json')
+
+    def get(self, top_core, flags, content_hash):
+        """Return the names of the resolved cores or None on a miss"""
+        if content_hash is None:
+            return None
+        try:
+            with open(self._cache_file(top_core, flags, content_hash)) as f:
+                return json.load(f)
+        except (IOError, OSError, ValueError):
+            return None
+
+    def set(self, top_core, flags, content_hash, names):
+        if content_hash is None:
+            return
+        cache_file = self._cache_file(top_core, flags, content_hash)
+        try:
+            if not os.path.exists(self.cache_dir):
+                os.makedirs(self.cache_dir)
+            with open(cache_file, 'w') as f:
+                json.dump(names, f)
+        except (IOError, OSError) as e:
+            logger.debug("Failed to write resolution cache : " + str(e))
+
+class LockFile(object):
+    """A file recording known-good dependency resolutions
+
+    Each resolution lists the resolved cores together with a SHA1 of
+    their core files. A resolution is only used when all the locked
+    cores are available with unchanged core files"""
+
+    def __init__(self, path):
+        self.path = path
+        self.resolutions = []
+        if os.path.exists(path):
+            data = yaml_fread(path) or {}
+            if data.get('lockfile_version') != LOCKFILE_VERSION:
+                raise RuntimeError("Unsupported lockfile version in {}".format(path))
+            self.resolutions = data.get('resolutions') or []
+
+    def _find(self, top_core, flags):
+        flags = _normalize_flags(flags)
+        for resolution in self.resolutions:
+            if resolution['top'] == str(top_core) and \
+               (resolution.get('flags') or {}) == flags:
+                return resolution
+
+    def get(self, top_core, flags, db):
+        """Return the locked cores, or None if there is no valid resolution"""
+        resolution = self._find(top_core, flags)
+        if not resolution:
+            return None
+        names = [c['name'] for c in resolution['cores']]
+        cores = db.get_cores(names)
+        if cores is None:
+            logger.warning("Ignoring locked resolution for {}. Locked cores are missing".format(top_core))
+            return None
+        for core, locked in zip(cores, resolution['cores']):
+            if _file_hash(core.core_file) != locked['sha1']:
+                logger.warning("Ignoring locked resolution for {}. {} has changed".format(top_core, locked['name']))
+                return None
+        return cores
+
+    def set(self, top_core, flags, cores):
+        resolution = self._find(top_core, flags)
+        if not resolution:
+            resolution = {'top'   : str(top_core),
+                          'flags' : _normalize_flags(flags)}
+            self.resolutions.append(resolution)
+        resolution['cores'] = [{'name' : str(core.name),
+                                'sha1' : _file_hash(core.core_file)}
+                               for core in cores]
+
+    def save(self):
+        yaml_fwrite(self.path, {'lockfile_version' : LOCKFILE_VERSION,
+                                'resolutions'      : self.resolutions})
@@ -1,9 +1,12 @@
 #!/usr/bin/env python
 import argparse
+import hashlib
+import json
 import os
 import subprocess
 import sys
 import signal
+import time
 
 from fusesoc import __version__
 
@@ -15,10 +18,8 @@ if os.path.exists(os.path.join(fusesocdir, "fusesoc")):
 from fusesoc.config import Config
 from fusesoc.coremanager import CoreManager, DependencyError
 from fusesoc.librarymanager import Library
-from fusesoc.edalizer import Edalizer
-from edalize import get_edatool
 from fusesoc.vlnv import Vlnv
-from fusesoc.utils import Launcher, setup_logging
+from fusesoc.utils import EXPORT_MODES, Launcher, setup_logging
 
 import logging
 
@@ -81,14 +82,83 @@ def pgm(cm, args):
                 flags, None, args.system, args.backendargs, None)
 
 def fetch(cm, args):
+    from fusesoc.edalizer import setup_cores
+
     core = _get_core(cm, args.core)
 
+    #Fetch the dependencies for all requested targets and tools
+    cores = []
+    seen = set()
+    for name, flags in _get_combinations(core, args.combination):
+        if not flags['tool']:
+            logger.warning("{} : No tool was supplied on command line or found in '{}' core description. Only fetching the core itself".format(name, args.core))
+            deps = [core]
+        else:
+            try:
+                deps = cm.get_depends(core.name, flags)
+            except DependencyError as e:
+                logger.error(e.msg + "\nFailed to resolve dependencies for {}".format(args.core))
+                exit(1)
+        for dep in deps:
+            if not str(dep.name) in seen:
+                seen.add(str(dep.name))
+                cores.append(dep)
+
+    remote = [dep for dep in cores if getattr(dep, 'provider', None)]
+    cached = set(id(dep) for dep in remote
+                 if dep.provider.status() == 'downloaded')
+
+    #Per-provider totals of [cores, fetched cores, bytes, seconds]
+    summary = {}
+    done = []
+    def progress(dep, seconds, error):
+        done.append(dep)
+        status = "[{}/{}] {}".format(len(done), len(remote), str(dep.name))
+        if error:
+            logger.error("{} : Failed to fetch : {}".format(status, str(error)))
+            return
+        provider = type(dep.provider).__name__.lower()
+        totals = summary.setdefault(provider, [0, 0, 0, 0.0])
+        totals[0] += 1
+        if id(dep) in cached:
+            logger.info("{} : Already in cache".format(status))
+            return
+        size = _get_size(dep.files_root)
+        totals[1] += 1
+        totals[2] += size
+        totals[3] += seconds
+        logger.info("{} : Fetched {} in {:.1f}s".format(status, _format_size(size), seconds))
+
+    start = time.time()
     try:
-        core.setup()
+        setup_cores(remote, cm.config.jobs, progress)
     except RuntimeError as e:
-        logger.error("Failed to fetch '{}': {}".format(core.name, str(e)))
+        logger.error("Failed to fetch '{}': {}".format(args.core, str(e)))
         exit(1)
 
+    for provider, (count, fetched, size, seconds) in sorted(summary.items()):
+        print("{} : {} cores, {} fetched, {} in {:.1f}s".format(
+            provider, count, fetched, _format_size(size), seconds))
+    print("Fetched {} of {} remote cores in {:.1f}s".format(
+        sum(totals[1] for totals in summary.values()),
+        len(remote),
+        time.time() - start))
+
+def _get_size(path):
+    size = 0
+    for root, dirs, files in os.walk(path):
+        for f in files:
+            size += os.lstat(os.path.join(root, f)).st_size
+    return size
+
+def _format_size(size):
+    if size < 1000:
+        return "{} B".format(size)
+    for unit in ['kB', 'MB', 'GB']:
+        size /= 1000.0
+        if size < 1000 or unit == 'GB':
+            return "{:.1f} {}".format(size, unit)
+
 def init(cm, args):
     # Fix Python 2.x.
     global input
@@ -237,6 +307,52 @@ def core_info(cm, args):
     core = _get_core(cm, args.core)
     print(core.info())
 
+def _get_combinations(core, combinations):
+    #Turn TARGET:TOOL strings into named flag sets, using the default
+    #target and tool of the core for the parts that are left out
+    result = []
+    for combination in combinations or [':']:
+        target, _, tool = combination.partition(':')
+        flags = {'target' : target or None,
+                 'tool'   : tool or None}
+        try:
+            flags['tool'] = core.get_tool(flags)
+        except SyntaxError as e:
+            logger.error(str(e))
+            exit(1)
+        name = "target {}, tool {}".format(flags['target'] or 'default',
+                                           flags['tool'])
+        result.append((name, flags))
+    return result
+
+def core_resolve(cm, args):
+    core = _get_core(cm, args.core)
+    combinations = _get_combinations(core, args.combination)
+
+    #Resolve all combinations in one go to share the work between them
+    valid = [flags for (name, flags) in combinations if flags['tool']]
+    results = iter(cm.get_depends_many(core.name, valid))
+
+    failed = False
+    for name, flags in combinations:
+        if not flags['tool']:
+            print("{} : No tool was supplied on command line or found in '{}' core description".format(name, args.core))
+            failed = True
+            continue
+        deps, error = next(results)
+        if error and error.msg:
+            print("{} : {}".format(name, error.msg))
+            failed = True
+        elif error:
+            print("{} : '{}' or any of its dependencies requires '{}', but this core was not found".format(name, args.core, error.value))
+            failed = True
+        else:
+            print(name + " :")
+            for dep in deps:
+                print("  " + str(dep.name))
+    if failed:
+        exit(1)
+
 def run(cm, args):
     stages = (args.setup, args.build, args.run)
     #Run all stages by default if no stage flags are set
@@ -260,34 +376,118 @@ def run(cm, args):
                 flags, args.system_name, args.system, args.backendargs, args.build_root)
 
 
+def _run_record_file(cm, system, flags, build_root_arg):
+    #Identifies an invocation by everything that affects where its
+    #EDAM file ends up
+    key = json.dumps([system,
+                      sorted(flags.items()),
+                      build_root_arg,
+                      cm.config.build_root,
+                      [l.location for l in cm.get_libraries()]])
+    return os.path.join(cm.config.cache_root,
+                        'runs',
+                        hashlib.sha1(key.encode('utf-8')).hexdigest() + '.json')
+
+def _stat(path):
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return [st.st_mtime, st.st_size]
+
+def _core_file_stats(cm, cores):
+    #Stat info of the core files of the resolved cores and of the
+    #directories above them up to the library root. Cores added next to
+    #the resolved ones, e.g. a new version, change the directory mtimes
+    libraries = set(os.path.abspath(os.path.expanduser(l.location))
+                    for l in cm.get_libraries())
+    paths = set()
+    for core in cores:
+        path = os.path.abspath(core.core_file)
+        paths.add(path)
+        path = os.path.dirname(path)
+        while not path in paths:
+            paths.add(path)
+            if path in libraries or os.path.dirname(path) == path:
+                break
+            path = os.path.dirname(path)
+    return {path : _stat(path) for path in paths}
+
+def _read_run_record(record_file):
+    try:
+        with open(record_file) as f:
+            record = json.load(f)
+    except (IOError, OSError, ValueError):
+        return None
+    if not os.path.exists(record.get('eda_api_file', '')):
+        return None
+    #The record is only valid while the resolved cores are unchanged
+    core_files = record.get('core_files')
+    if not core_files:
+        return None
+    for path, stat in core_files.items():
+        if _stat(path) != stat:
+            logger.debug("{} has changed since the last setup".format(path))
+            return None
+    return record
+
+def _write_run_record(record_file, record):
+    try:
+        if not os.path.exists(os.path.dirname(record_file)):
+            os.makedirs(os.path.dirname(record_file))
+        with open(record_file, 'w') as f:
+            json.dump(record, f)
+    except (IOError, OSError) as e:
+        logger.debug("Failed to write run record : " + str(e))
+
 def run_backend(cm, export, do_configure, do_build, do_run, flags, system_name, system, backendargs, build_root_arg):
+    from edalize import get_edatool
+    from fusesoc.edalizer import Edalizer, load_edam
+
     tool_error = "No tool was supplied on command line or found in '{}' core description"
-    core = _get_core(cm, system)
-    try:
-        tool = core.get_tool(flags)
-    except SyntaxError as e:
-        logger.error(str(e))
-        exit(1)
-    if not tool:
-        logger.error(tool_error.format(system))
-        exit(1)
-    flags['tool'] = tool
-    build_root = build_root_arg or os.path.join(cm.config.build_root, core.name.sanitized_name)
-    logger.debug('Setting build_root to {}'.format(build_root))
-    if export:
-        export_root = os.path.join(build_root, 'src')
+    record_file = _run_record_file(cm, system, flags, build_root_arg)
+
+    #If only the build or run stages are requested and this system was
+    #configured before, the EDAM file is all we need. This avoids
+    #scanning the libraries and looking up the core
+    record = None
+    if not do_configure:
+        record = _read_run_record(record_file)
+    if record:
+        logger.debug("Using previously configured EDAM file " + record['eda_api_file'])
+        core_name    = record['core']
+        tool         = record['tool']
+        work_root    = record['work_root']
+        eda_api_file = record['eda_api_file']
+        flags['tool'] = tool
     else:
-        export_root = None
-    try:
-        work_root   = os.path.join(build_root,
-                                   core.get_work_root(flags))
-    except SyntaxError as e:
-        logger.error(e.msg)
-        exit(1)
-    eda_api_file = os.path.join(work_root,
-                                core.name.sanitized_name+'.eda.yml')
-    if not os.path.exists(eda_api_file):
-        do_configure = True
+        core = _get_core(cm, system)
+        core_name = str(core.name)
+        try:
+            tool = core.get_tool(flags)
+        except SyntaxError as e:
+            logger.error(str(e))
+            exit(1)
+        if not tool:
+            logger.error(tool_error.format(system))
+            exit(1)
+        flags['tool'] = tool
+        build_root = build_root_arg or os.path.join(cm.config.build_root, core.name.sanitized_name)
+        logger.debug('Setting build_root to {}'.format(build_root))
+        if export:
+            export_root = os.path.join(build_root, 'src')
+        else:
+            export_root = None
+        try:
+            work_root   = os.path.join(build_root,
+                                       core.get_work_root(flags))
+        except SyntaxError as e:
+            logger.error(e.msg)
+            exit(1)
+        eda_api_file = os.path.join(work_root,
+                                    core.name.sanitized_name+'.eda.yml')
+        if not os.path.exists(eda_api_file):
+            do_configure = True
 
     if do_configure:
         try:
@@ -305,7 +505,9 @@ def run_backend(cm, export, do_configure, do_build, do_run, flags, system_name,
                                 cache_root=cm.config.cache_root,
                                 work_root=work_root,
                                 export_root=export_root,
-                                system_name=system_name)
+                                system_name=system_name,
+                                jobs=cm.config.jobs,
+                                export_mode=cm.config.export_mode)
         except SyntaxError as e:
             logger.error(e.msg)
             exit(1)
@@ -313,6 +515,11 @@ def run_backend(cm, export, do_configure, do_build, do_run, flags, system_name,
             logger.error("Setup failed : {}".format(str(e)))
             exit(1)
         edalizer.to_yaml(eda_api_file)
+        _write_run_record(record_file, {'core'         : core_name,
+                                        'tool'         : tool,
+                                        'work_root'    : work_root,
+                                        'eda_api_file' : eda_api_file,
+                                        'core_files'   : _core_file_stats(cm, cores)})
 
     #Frontend/backend separation
 
@@ -320,8 +527,7 @@ def run_backend(cm, export, do_configure, do_build, do_run, flags, system_name,
         if do_configure:
             edam = edalizer.edalize
         else:
-            import yaml
-            edam = yaml.safe_load(open(eda_api_file))
+            edam = load_edam(eda_api_file)
         backend = get_edatool(tool)(edam=edam,
                                     work_root=work_root)
 
@@ -335,7 +541,10 @@ def run_backend(cm, export, do_configure, do_build, do_run, flags, system_name,
         logger.error('Could not find EDA API file "{}"'.format(e.filename))
         exit(1)
 
-    if do_configure:
+    if do_configure and edalizer.is_configured(backendargs):
+        logger.info("Inputs unchanged since the last setup. Skipping configure")
+    elif do_configure:
+        edalizer.set_configured(None)
         try:
             backend.configure(backendargs)
             print('')
@@ -343,12 +552,13 @@ def run_backend(cm, export, do_configure, do_build, do_run, flags, system_name,
             logger.error("Failed to configure the system")
             logger.error(str(e))
             exit(1)
+        edalizer.set_configured(backendargs)
 
     if do_build:
         try:
             backend.build()
         except RuntimeError as e:
-            logger.error("Failed to build {} : {}".format(str(core.name),
+            logger.error("Failed to build {} : {}".format(core_name,
                                                           str(e)))
             exit(1)
 
@@ -356,7 +566,7 @@ def run_backend(cm, export, do_configure, do_build, do_run, flags, system_name,
         try:
             backend.run(backendargs)
         except RuntimeError as e:
-            logger.error("Failed to run {} : {}".format(str(core.name),
+            logger.error("Failed to run {} : {}".format(core_name,
                                                         str(e)))
             exit(1)
 
@@ -426,6 +636,10 @@ def parse_args():
     parser.add_argument('--monochrome', help='Don\'t use color for messages', action='store_true', default=not sys.stdout.isatty())
     parser.add_argument('--verbose', help='More info messages', action='store_true')
     parser.add_argument('--log-file', help='Write log messages to file')
+    parser.add_argument('--jobs', '-j', type=int, help='Number of parallel jobs to use for parsing and fetching cores')
+    parser.add_argument('--export-mode', choices=EXPORT_MODES, help='How to export source files to the build tree. reflink and link avoid copying the file data where the file system allows it. With link, exported files are hardlinks or symlinks to the originals')
+    parser.add_argument('--lockfile', help='Use resolved dependencies from this file (defaults to fusesoc.lock if it exists)')
+    parser.add_argument('--update-lockfile', action='store_true', help='Resolve dependencies and record the result in the lockfile')
 
     # build subparser
     parser_build = subparsers.add_parser('build', help='Build an FPGA load module')
@@ -450,6 +664,7 @@ def parse_args():
 
     # fetch subparser
     parser_fetch = subparsers.add_parser('fetch', help='Fetch a remote core and its dependencies to local cache')
+    parser_fetch.add_argument('--combination', action='append', metavar='TARGET:TOOL', help='Target and tool to fetch dependencies for. Leave out either part to use the default. Can be given several times')
     parser_fetch.add_argument('core')
     parser_fetch.set_defaults(func=fetch)
 
@@ -467,6 +682,12 @@ def parse_args():
     parser_core_show.add_argument('core', help='Name of the core to show')
     parser_core_show.set_defaults(func=core_info)
 
+    # core resolve subparser
+    parser_core_resolve = core_subparsers.add_parser('resolve', help='Resolve the dependencies of a core for several targets and tools')
+    parser_core_resolve.add_argument('--combination', action='append', metavar='TARGET:TOOL', help='Target and tool to resolve for. Leave out either part to use the default. Can be given several times')
+    parser_core_resolve.add_argument('core', help='Name of the core to resolve')
+    parser_core_resolve.set_defaults(func=core_resolve)
+
     # list-cores subparser
     parser_list_cores = subparsers.add_parser('list-cores', help='List available cores')
     parser_list_cores.set_defaults(func=list_cores)
@@ -568,6 +789,16 @@ def main():
 
     init_logging(args.verbose, args.monochrome, args.log_file)
     config = Config(file=args.config)
+    if args.jobs:
+        config.jobs = args.jobs
+    if args.export_mode:
+        config.export_mode = args.export_mode
+    if args.lockfile:
+        config.lockfile = os.path.abspath(args.lockfile)
+    if args.update_lockfile:
+        config.update_lockfile = True
+        if not config.lockfile:
+            config.lockfile = os.path.abspath('fusesoc.lock')
 
     cm = init_coremanager(config, args.cores_root)
     # Run the function
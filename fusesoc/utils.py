@@ -1,5 +1,6 @@
 import subprocess
 import logging
+import shutil
 import sys
 import importlib
 
@@ -41,9 +42,140 @@ def cygpath(win_path):
 
 import os
 
+#yaml is imported on first use to keep startup time down
+_yaml_loader = None
+_yaml_dumper = None
+
+def _represent_str(dumper, data):
+    return dumper.represent_str(str(data))
+
+def _get_yaml():
+    global _yaml_loader, _yaml_dumper
+    import yaml
+    if _yaml_loader is None:
+        try:
+            from yaml import CSafeLoader as Loader
+            from yaml import CSafeDumper as Dumper
+        except ImportError:
+            from yaml import SafeLoader as Loader
+            from yaml import SafeDumper as Dumper
+
+        class YamlDumper(Dumper):
+            pass
+
+        #Dump str subclasses (e.g. CAPI2 Strings) as plain strings
+        YamlDumper.add_multi_representer(str, _represent_str)
+
+        _yaml_loader = Loader
+        _yaml_dumper = YamlDumper
+    return yaml
+
+def yaml_load(stream):
+    """Load YAML data, using the libyaml parser if available"""
+    return _get_yaml().load(stream, Loader=_yaml_loader)
+
+def yaml_fread(filepath):
+    with open(filepath) as f:
+        return yaml_load(f)
+
+def yaml_dump(data):
+    """Dump data as YAML, using the libyaml emitter if available"""
+    return _get_yaml().dump(data, Dumper=_yaml_dumper, default_flow_style=False)
+
+def yaml_fwrite(filepath, data):
+    with open(filepath, 'w') as f:
+        _get_yaml().dump(data, f, Dumper=_yaml_dumper, default_flow_style=False)
+
 def unique_dirs(file_list):
     return list(set([os.path.dirname(f.name) for f in file_list]))
 
+#Ways of putting exported files into the build tree
+# copy    : Copy the files
+# reflink : Let the copies share data blocks with the originals on file
+#           systems that support it (e.g. btrfs and XFS). Copy otherwise
+# link    : Hardlink, or symlink across file systems. Exported files
+#           must then not be modified in place, as that would change the
+#           originals
+EXPORT_MODES = ['copy', 'reflink', 'link']
+
+#Linux ioctl that makes a file share the data blocks of another file
+_FICLONE = 0x40049409
+
+#(source, destination) device pairs where reflinking has failed
+_no_reflink = set()
+
+def _reflink(src, dst):
+    try:
+        import fcntl
+    except ImportError:
+        return False
+    devices = (os.stat(src).st_dev,
+               os.stat(os.path.dirname(os.path.abspath(dst))).st_dev)
+    if devices in _no_reflink:
+        return False
+    with open(src, 'rb') as fsrc:
+        with open(dst, 'wb') as fdst:
+            try:
+                fcntl.ioctl(fdst.fileno(), _FICLONE, fsrc.fileno())
+                return True
+            except (IOError, OSError) as e:
+                logger.debug("Reflinking not supported from {} to {}: {}".format(src, dst, str(e)))
+    os.remove(dst)
+    _no_reflink.add(devices)
+    return False
+
+def _is_exported(src, dst, mode):
+    #Copies get the mtime of the source, so they are up to date if the
+    #size and the mtime still match. Sources restored with their old
+    #mtime are then exported again. Links must point to the source, so
+    #that copies from another export mode are replaced
+    try:
+        if os.path.samefile(src, dst):
+            return mode == 'link'
+        if mode == 'link' or os.path.islink(dst):
+            return False
+        st_src = os.stat(src)
+        st_dst = os.stat(dst)
+    except OSError:
+        return False
+    return st_src.st_size == st_dst.st_size and \
+        st_src.st_mtime == st_dst.st_mtime
+
+def export_file(src, dst, mode='copy'):
+    """Put the file src at dst in the given export mode, copying it when
+    the mode is 'copy' or the cheaper ways are not available. Files that
+    are already exported are left untouched, so that their mtimes don't
+    trigger rebuilds"""
+    if _is_exported(src, dst, mode):
+        return
+    if os.path.lexists(dst):
+        os.remove(dst)
+    if mode == 'reflink' and _reflink(src, dst):
+        shutil.copystat(src, dst)
+        return
+    if mode == 'link':
+        try:
+            os.link(src, dst)
+            return
+        except (AttributeError, OSError):
+            pass
+        try:
+            os.symlink(os.path.abspath(src), dst)
+            return
+        except (AttributeError, NotImplementedError, OSError):
+            pass
+    shutil.copy2(src, dst)
+
+def prune_export(dst_dir, files):
+    """Remove everything but files, given relative to dst_dir, from an
+    export directory"""
+    keep = set(os.path.normpath(os.path.join(dst_dir, f)) for f in files)
+    for root, dirs, _files in os.walk(dst_dir):
+        for f in _files:
+            path = os.path.join(root, f)
+            if not path in keep:
+                os.remove(path)
+
 
 # With help from:
 # http://stackoverflow.com/questions/384076/how-can-i-color-python-logging-output
@@ -1,93 +1,214 @@
+import re
+from collections import OrderedDict
 from functools import total_ordering
 
-@total_ordering
-class Vlnv(object):
-    def __init__(self, s, default_relation = ">="):
-        def _is_rev(s):
-            return s.startswith('r') and s[1:].isdigit()
-        def _is_version(s):
-            return s[0].isdigit()
-
-        if s.startswith('!'):
-            self.conflict = True
-            _s = s[1:]
-        else:
-            self.conflict = False
-            _s = s[:]
-        if _s[0:2] in ['>=', '<=']:
-            self.relation = _s[0:2]
-            _s = _s[2:]
-        elif s[0] in ['>', '<']:
-            self.relation = s[0]
-            _s = _s[1:]
-        elif s[0] in ['=']:
-            self.relation = "=="
-            _s = _s[1:]
+#Maximum number of parsed strings to keep
+PARSE_CACHE_SIZE = 4096
+
+_parse_cache = OrderedDict()
+
+#PEP 386 versions, as accepted by the solver
+_VERSION_RE = re.compile(r"""
+    ^
+    (?P<version>\d+)
+    (?P<extraversion>(?:\.\d+)*)
+    (?:
+        (?P<prerel>[abc]|rc|\.dev)
+        (?P<prerelversion>\d+(?:\.\d+)*)
+    )?
+    (?P<postdev>(\.post(?P<post>\d+))?(\.dev(?P<dev>\d+))?)?
+    $""", re.VERBOSE)
+
+def _numdots(s):
+    nums = []
+    for n in s.split('.'):
+        if len(n) > 1 and n[0] == '0':
+            return None
+        nums.append(int(n))
+    return nums
+
+def _pep386_key(version):
+    match = _VERSION_RE.search(version)
+    if not match:
+        return None
+    groups = match.groupdict()
+
+    numdot = _numdots(groups['version'] + groups['extraversion'])
+    if numdot is None:
+        return None
+    while numdot and numdot[-1] == 0:
+        numdot.pop()
+
+    prerel = groups['prerel']
+    if prerel is None:
+        prerel_parts = ('f',)
+    else:
+        prerelversion = _numdots(groups['prerelversion'])
+        if prerelversion is None:
+            return None
+        #'`' sorts before 'a'
+        prerel = {'rc' : 'c', '.dev' : '`'}.get(prerel, prerel)
+        prerel_parts = tuple([prerel] + prerelversion)
+
+    if groups['postdev']:
+        postdev = []
+        if groups['post'] is not None:
+            postdev += ['f', 'post', int(groups['post'])]
+            if groups['dev'] is None:
+                postdev.append('f')
+        if groups['dev'] is not None:
+            postdev += ['dev', int(groups['dev'])]
+        postdev = tuple(postdev)
+    else:
+        postdev = ('f',)
+    return (tuple(numdot), prerel_parts, postdev)
+
+def version_key(version, revision=0):
+    """Return a key that orders versions and revisions the same way as the
+    dependency solver does, or None if the solver can't handle the version
+
+    Versions following PEP 386 are compared by their parts, so that e.g.
+    1.10 is newer than 1.9. Other versions are compared as a list of
+    dot-separated strings and are older than all PEP 386 versions"""
+    #The solver sees the version as <version>-<revision>
+    if '-' in version:
+        return None
+    key = _pep386_key(version)
+    if key is None:
+        return ((0, tuple(version.split('.'))), revision)
+    return ((1, key), revision)
+
+def _parse(s, default_relation):
+    def _is_rev(s):
+        return s.startswith('r') and s[1:].isdigit()
+    def _is_version(s):
+        return s[0].isdigit()
+
+    if s.startswith('!'):
+        conflict = True
+        _s = s[1:]
+    else:
+        conflict = False
+        _s = s[:]
+    if _s[0:2] in ['>=', '<=']:
+        relation = _s[0:2]
+        _s = _s[2:]
+    elif s[0] in ['>', '<']:
+        relation = s[0]
+        _s = _s[1:]
+    elif s[0] in ['=']:
+        relation = "=="
+        _s = _s[1:]
+    else:
+        relation = ""
+
+    vlnv_parts = _s.split(':')
+
+    revision = 0
+    #legacy naming. Only name
+    if len(vlnv_parts) == 1:
+        vendor  = ""
+        library = ""
+        sl = vlnv_parts[0].rsplit('-')
+        if len(sl) == 1:
+            #Simplest case. No '-' => Only name
+            name = s
+            version = ""
         else:
-            self.relation = ""
-
-        vlnv_parts = _s.split(':')
-
-        self.revision = 0
-        #legacy naming. Only name
-        if len(vlnv_parts) == 1:
-            self.vendor  = ""
-            self.library = ""
-            sl = vlnv_parts[0].rsplit('-')
-            if len(sl) == 1:
-                #Simplest case. No '-' => Only name
-                self.name = s
-                self.version = ""
-            else:
-                #If last part is the revision, save and pop from list
-                if _is_rev(sl[-1]):
-                    self.revision = int(sl.pop()[1:])
-
-                #If last part is version, save and pop from list
-                if len(sl) > 1 and _is_version(sl[-1]):
-                    self.version = sl.pop()
-                else:
-                    self.version = ""
-
-                self.name    = '-'.join(sl)
-
-        #No version tag
-        elif len(vlnv_parts) == 3:
-            self.vendor  = vlnv_parts[0]
-            self.library = vlnv_parts[1]
-            self.name    = vlnv_parts[2]
-            self.version = ""
-        #Full vlnv
-        elif len(vlnv_parts) == 4:
-            self.vendor  = vlnv_parts[0]
-            self.library = vlnv_parts[1]
-            self.name    = vlnv_parts[2]
-            sl = vlnv_parts[3].split('-')
-            if len(sl) > 1 and _is_rev(sl[-1]):
-                self.revision = int(sl.pop()[1:])
-                self.version = '-'.join(sl)
+            #If last part is the revision, save and pop from list
+            if _is_rev(sl[-1]):
+                revision = int(sl.pop()[1:])
+
+            #If last part is version, save and pop from list
+            if len(sl) > 1 and _is_version(sl[-1]):
+                version = sl.pop()
             else:
-                self.version = vlnv_parts[3]
+                version = ""
+
+            name    = '-'.join(sl)
+
+    #No version tag
+    elif len(vlnv_parts) == 3:
+        vendor  = vlnv_parts[0]
+        library = vlnv_parts[1]
+        name    = vlnv_parts[2]
+        version = ""
+    #Full vlnv
+    elif len(vlnv_parts) == 4:
+        vendor  = vlnv_parts[0]
+        library = vlnv_parts[1]
+        name    = vlnv_parts[2]
+        sl = vlnv_parts[3].split('-')
+        if len(sl) > 1 and _is_rev(sl[-1]):
+            revision = int(sl.pop()[1:])
+            version = '-'.join(sl)
         else:
-            raise SyntaxError("Illegal core name '{}'".format(s))
-
-        if self.version or (self.revision > 0):
-            if not self.relation:
-                # Version specified without relational operator
-                # Assume user wants the exact version
-                self.relation = "=="
-            if not self.version:
-                self.version = "0"
+            version = vlnv_parts[3]
+    else:
+        raise SyntaxError("Illegal core name '{}'".format(s))
+
+    if version or (revision > 0):
+        if not relation:
+            # Version specified without relational operator
+            # Assume user wants the exact version
+            relation = "=="
+        if not version:
+            version = "0"
+    else:
+        if relation:
+            _s = "{}: '{}' operator requires a version "
+            raise SyntaxError(_s.format(s, relation))
+        #No version specifier means any version i.e. >=0
+        version = "0"
+        relation = default_relation
+
+    return (conflict, relation, vendor, library, name, version, revision,
+            version_key(version, revision))
+
+@total_ordering
+class Vlnv(object):
+    __slots__ = ('conflict', 'relation', 'vendor', 'library', 'name',
+                 'version', 'revision', 'version_key', '_key',
+                 '_sanitized_name')
+
+    def __init__(self, s, default_relation = ">="):
+        #The same strings are parsed over and over again, e.g. for every
+        #dependency each time the dependencies of a core are requested.
+        #Vlnv objects are mutable, so only the parsed fields are cached
+        key = (s, default_relation)
+        try:
+            fields = _parse_cache[key]
+        except KeyError:
+            fields = _parse(s, default_relation)
+            if len(_parse_cache) >= PARSE_CACHE_SIZE:
+                _parse_cache.popitem(last=False)
+            _parse_cache[key] = fields
+        (self.conflict,
+         self.relation,
+         self.vendor,
+         self.library,
+         self.name,
+         self.version,
+         self.revision,
+         self.version_key) = fields
+
+        #Key for comparisons and hashing. Only the relation is expected
+        #to change after creation. Versions and revisions are compared
+        #like the solver compares them, so e.g. 1.0 and 1.0.0 are equal.
+        #Versions the solver can't handle are compared as strings and
+        #are ordered before all others
+        if self.version_key is None:
+            _version = (0, self.version)
         else:
-            if self.relation:
-                _s = "{}: '{}' operator requires a version "
-                raise SyntaxError(_s.format(s, self.relation))
-            #No version specifier means any version i.e. >=0
-            self.version = "0"
-            self.relation = default_relation
+            _version = (1, self.version_key)
+        self._key = (self.vendor, self.library, self.name, _version)
+        self._sanitized_name = None
 
-        #Create sanitized name
-        self.sanitized_name = str(self).lstrip(':').replace(":", "_")
+    @property
+    def sanitized_name(self):
+        if self._sanitized_name is None:
+            self._sanitized_name = str(self).lstrip(':').replace(":", "_")
+        return self._sanitized_name
 
     def __str__(self):
         if self.relation == '=':
@@ -113,9 +234,13 @@ class Vlnv(object):
         return relation+str(self)
 
     def __eq__(self, other):
-        return ((self.vendor , self.library , self.name , self.version) ==
-                (other.vendor, other.library, other.name, other.version))
+        return self._key == other._key
+
+    def __ne__(self, other):
+        return not self == other
 
     def __lt__(self, other):
-        return ((self.vendor , self.library , self.name , self.version) <
-                (other.vendor, other.library, other.name, other.version))
+        return self._key < other._key
+
+    def __hash__(self):
+        return hash(self._key)
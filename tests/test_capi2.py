@@ -509,3 +509,167 @@ def test_capi2_info():
         gen_info = '\n'.join([x for x in core.info().split('\n') if not 'Core root' in x])
         with open(os.path.join(tests_dir, __name__, core_name+".info")) as f:
             assert f.read() == gen_info, core_name
+
+def test_capi2_string_parse():
+    from fusesoc.capi2.core import String
+
+    s = String("a tool_icarus? (b !is_toplevel? (c) d) !tool_icarus? (e)")
+    assert s.parse({'tool' : 'icarus', 'is_toplevel' : False}) == 'a b c d'
+    assert s.parse({'tool' : 'icarus', 'is_toplevel' : True})  == 'a b d'
+    assert s.parse({'tool' : 'verilator'}) == 'a e'
+
+    #Expressions are compiled once and reused for all flag sets
+    compiled = s.compile()
+    s.parse({'tool' : 'modelsim'})
+    assert s.compile() is compiled
+
+def test_capi2_string_parse_cache():
+    from fusesoc.capi2.core import String, frozen_flags
+
+    assert frozen_flags({'tool' : 'icarus', 'is_toplevel' : True, 'x' : False}) == \
+        frozenset(['tool_icarus', 'is_toplevel'])
+
+    s = String("a tool_icarus? (b)")
+    assert s.parse({'tool' : 'icarus', 'target' : 'sim'}) == 'a b'
+    assert s.parse({'tool' : 'icarus', 'target' : 'synth'}) == 'a b'
+    assert s.parse({'tool' : 'verilator', 'target' : 'sim'}) == 'a'
+    assert s.parse({'tool' : 'modelsim', 'target' : 'sim'}) == 'a'
+    #Flags not referenced by the expression don't create new entries
+    assert len(s._results) == 2
+
+def test_capi2_flag_signature():
+    import tempfile
+    from fusesoc.core import Core
+
+    core_file = tempfile.NamedTemporaryFile(mode='w', suffix='.core', delete=False)
+    core_file.write("""CAPI=2:
+name : ::signature:0
+filesets:
+  rtl:
+    depend: [dep_a, "tool_verilator? (dep_b)"]
+  tb:
+    depend: ["!is_toplevel? (dep_c)"]
+parameters:
+  p:
+    datatype : str
+    paramtype : "tool_icarus? (plusarg) !tool_icarus? (vlogdefine)"
+targets:
+  default:
+    filesets : [rtl, "target_sim? (tb)"]
+    parameters : [p]
+    toplevel : "use_top? (top)"
+  other:
+    filesets : [rtl]
+""")
+    core_file.close()
+    core = Core(core_file.name)
+
+    assert core.flag_signature('default') == frozenset(
+        ['tool_verilator', 'target_sim', 'is_toplevel', 'tool_icarus', 'use_top'])
+    assert core.flag_signature('other') == frozenset(['tool_verilator'])
+
+    #The target and tool flags are reduced to what the target uses
+    assert core.flags_key({'is_toplevel' : True, 'target' : 'other', 'tool' : 'icarus'}) == \
+        ('other', frozenset())
+    assert core.flags_key({'is_toplevel' : True, 'target' : 'other', 'tool' : 'verilator'}) == \
+        ('other', frozenset(['tool_verilator']))
+    assert core.flags_key({'tool' : 'icarus'}) == \
+        ('default', frozenset(['tool_icarus']))
+    assert core.flags_key({'is_toplevel' : True, 'target' : 'missing'}) == \
+        (None, frozenset())
+
+def test_capi2_resolve():
+    from fusesoc.core import Core
+
+    core = Core(os.path.join(cores_dir, "generate.core"))
+
+    flags = {'is_toplevel' : True, 'tool' : 'icarus'}
+    resolved = core.resolve(flags)
+    assert resolved.target == 'default'
+    assert list(resolved.generate) == core.get_ttptttg(flags)
+    assert resolved.parameters == core.get_parameters(flags)
+    assert resolved.tool_options == core.get_tool_options(flags)
+
+    #Flags that don't affect the target share the resolved view
+    assert core.resolve({'is_toplevel' : True, 'tool' : 'icarus', 'x' : True}) is resolved
+    assert core.resolve({'is_toplevel' : True, 'tool' : 'verilator'}) is not resolved
+
+    resolved = core.resolve({'is_toplevel' : True, 'target' : 'nogenerate'})
+    assert resolved.target == 'nogenerate'
+    assert resolved.generate == ()
+
+    core = Core(os.path.join(cores_dir, "files.core"))
+    flags = {'is_toplevel' : True, 'tool' : 'icarus'}
+    resolved = core.resolve(flags)
+    assert [f.name for f in resolved.files] == [f.name for f in core.get_files(flags)]
+    assert list(resolved.depends) == core.get_depends(flags)
+
+def test_capi2_debug_logging_is_lazy():
+    import logging
+
+    from fusesoc.core import Core
+
+    class Flag(str):
+        formatted = 0
+        def __repr__(self):
+            Flag.formatted += 1
+            return str.__repr__(self)
+
+    core = Core(os.path.join(cores_dir, "files.core"))
+    flags = {Flag('is_toplevel') : True, 'tool' : 'icarus'}
+
+    logger = logging.getLogger('fusesoc.capi2.core')
+    level = logger.level
+    try:
+        logger.setLevel(logging.INFO)
+        core.get_depends(flags)
+        core.get_files(flags)
+        core.get_parameters(flags)
+        assert Flag.formatted == 0
+
+        logger.setLevel(logging.DEBUG)
+        core.get_depends(flags)
+        assert Flag.formatted > 0
+    finally:
+        logger.setLevel(level)
+
+def test_capi2_export_modes():
+    import filecmp
+    import os
+    import tempfile
+    from fusesoc.core import Core
+
+    core = Core(os.path.join(tests_dir, "capi2_cores", "misc", "files.core"))
+    vlogfile = os.path.join(core.core_root, 'vlogfile')
+
+    for mode in ['copy', 'reflink', 'link']:
+        export_root = tempfile.mkdtemp(prefix='capi2_export_')
+        core.export(export_root, mode=mode)
+        exported = os.path.join(export_root, 'vlogfile')
+        assert filecmp.cmp(vlogfile, exported, shallow=False)
+        if mode == 'link':
+            assert os.path.samefile(vlogfile, exported)
+        else:
+            assert not os.path.samefile(vlogfile, exported)
+
+        #Exporting again replaces the exported files
+        core.export(export_root, mode=mode)
+        assert filecmp.cmp(vlogfile, exported, shallow=False)
+
+def test_capi2_export_mode_switch():
+    import os
+    import tempfile
+    from fusesoc.core import Core
+
+    core = Core(os.path.join(tests_dir, "capi2_cores", "misc", "files.core"))
+    vlogfile = os.path.join(core.core_root, 'vlogfile')
+
+    #Copies from an earlier export are replaced by links and vice versa
+    export_root = tempfile.mkdtemp(prefix='capi2_export_')
+    exported = os.path.join(export_root, 'vlogfile')
+    core.export(export_root, mode='copy')
+    assert not os.path.samefile(vlogfile, exported)
+    core.export(export_root, mode='link')
+    assert os.path.samefile(vlogfile, exported)
+    core.export(export_root, mode='copy')
+    assert not os.path.samefile(vlogfile, exported)
@@ -13,6 +13,8 @@ build_root = {build_root}
 cache_root = {cache_root}
 cores_root = {cores_root}
 library_root = {library_root}
+jobs = 4
+export_mode = link
 
 [library.test_lib]
 location = {library_root}/test_lib
@@ -34,6 +36,8 @@ def test_config_file():
     conf = Config(file=tcf)
 
     assert conf.build_root == build_root
+    assert conf.jobs == 4
+    assert conf.export_mode == 'link'
 
 def test_config_path():
     tcf = tempfile.NamedTemporaryFile(mode="w+")
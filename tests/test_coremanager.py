@@ -55,3 +55,390 @@ def test_export():
             'wb_intercon_1.0/rtl/verilog/wb_upsizer.v',
     ]:
         assert os.path.isfile(os.path.join(export_root, f))
+
+def test_core_index(monkeypatch):
+    import os
+    import shutil
+    import tempfile
+
+    import fusesoc.core
+    from fusesoc.config import Config
+    from fusesoc.coremanager import CoreManager
+    from fusesoc.librarymanager import Library
+
+    tests_dir = os.path.dirname(__file__)
+    cores_root = tempfile.mkdtemp(prefix='core_index_')
+    for f in ['depends.core', 'vpi.core']:
+        shutil.copy(os.path.join(tests_dir, 'capi2_cores', 'misc', f),
+                    cores_root)
+
+    config = Config()
+    config.cache_root = tempfile.mkdtemp(prefix='core_index_cache_')
+    library = Library('index_test', cores_root)
+
+    cm = CoreManager(config)
+    cm.load_cores(library)
+    expected = sorted(cm.get_cores())
+
+    #Unchanged cores must be loaded from the index without parsing
+    parsed = []
+    Core = fusesoc.core.Core
+    def _core(core_file, *args):
+        parsed.append(os.path.basename(core_file))
+        return Core(core_file, *args)
+    monkeypatch.setattr(fusesoc.core, 'Core', _core)
+
+    cm = CoreManager(config)
+    cm.load_cores(library)
+    assert parsed == []
+    assert sorted(cm.get_cores()) == expected
+
+    #Modified cores are parsed again
+    with open(os.path.join(cores_root, 'vpi.core'), 'a') as f:
+        f.write('\n')
+    cm = CoreManager(config)
+    cm.load_cores(library)
+    assert parsed == ['vpi.core']
+    assert sorted(cm.get_cores()) == expected
+
+def test_parallel_load_cores():
+    import os
+    import tempfile
+
+    from fusesoc.config import Config
+    from fusesoc.coremanager import CoreManager
+    from fusesoc.librarymanager import Library
+
+    tests_dir = os.path.dirname(__file__)
+    library = Library('parallel_test', os.path.join(tests_dir, 'cores'))
+
+    cores = {}
+    for jobs in [1, 4]:
+        config = Config()
+        config.cache_root = tempfile.mkdtemp(prefix='parallel_cache_')
+        config.jobs = jobs
+        cm = CoreManager(config)
+        cm.load_cores(library)
+        cores[jobs] = {k : v.core_root for k, v in cm.get_cores().items()}
+    assert cores[1]
+    assert cores[1] == cores[4]
+
+def _write_cores(cores):
+    import os
+    import tempfile
+
+    cores_root = tempfile.mkdtemp(prefix='cores_')
+    for name, data in cores.items():
+        with open(os.path.join(cores_root, name + '.core'), 'w') as f:
+            f.write("CAPI=2:\n" + data)
+    return cores_root
+
+def test_solve_only_reachable_cores():
+    import tempfile
+
+    from fusesoc.config import Config
+    from fusesoc.coremanager import CoreManager
+    from fusesoc.librarymanager import Library
+    from fusesoc.vlnv import Vlnv
+
+    cores_root = _write_cores({
+        'top' : """name : ::top:0
+filesets:
+  rtl:
+    depend: [">=::dep:1.0"]
+targets:
+  default:
+    filesets: [rtl]
+""",
+        'dep_1.0' : "name : ::dep:1.0\n",
+        'dep_1.1' : "name : ::dep:1.1\n",
+        #Evaluating the dependencies of this core fails, but it is
+        #never needed when solving for top
+        'unrelated' : """name : ::unrelated:0
+targets:
+  default:
+    filesets: [missing]
+""",
+    })
+
+    config = Config()
+    config.cache_root = tempfile.mkdtemp(prefix='reachable_cache_')
+    cm = CoreManager(config)
+    cm.load_cores(Library('reachable', cores_root))
+
+    deps = cm.get_depends(Vlnv('::top'), {})
+    assert [str(c.name) for c in deps] == ['::dep:1.1', '::top:0']
+
+def test_find_from_index(monkeypatch):
+    import os
+    import pytest
+
+    from fusesoc.coremanager import CoreDB, DependencyError
+    from fusesoc.librarymanager import Library
+    from fusesoc.core import Core
+    from fusesoc.vlnv import Vlnv
+
+    cores_root = _write_cores({
+        'dep_1.9'    : "name : ::dep:1.9\n",
+        'dep_1.10'   : "name : ::dep:1.10\n",
+        'dep_1.10r2' : "name : ::dep:1.10-r2\n",
+        'dep_2.0'    : "name : ::dep:2.0\n",
+        'other'      : "name : vendor:lib:dep:3.0\n",
+    })
+    db = CoreDB()
+    for f in sorted(os.listdir(cores_root)):
+        db.add(Core(os.path.join(cores_root, f)), Library('find', cores_root))
+
+    #Single core lookups must not run the solver
+    def _solve(*args, **kwargs):
+        raise AssertionError("Solver called")
+    monkeypatch.setattr(db, '_solve', _solve)
+
+    def find(s):
+        return str(db.find(Vlnv(s)).name)
+
+    assert find('::dep')          == '::dep:2.0'
+    assert find('>=::dep:1.10')   == '::dep:2.0'
+    assert find('<::dep:2.0')     == '::dep:1.10-r2'
+    assert find('<=::dep:1.10')   == '::dep:1.10'
+    assert find('>::dep:1.9')     == '::dep:2.0'
+    assert find('::dep:1.10-r2')  == '::dep:1.10-r2'
+    assert find('=::dep:1.9')     == '::dep:1.9'
+    assert find('vendor:lib:dep') == 'vendor:lib:dep:3.0'
+
+    with pytest.raises(DependencyError):
+        find('>::dep:2.0')
+    with pytest.raises(DependencyError):
+        find('::missing')
+
+def test_resolution_cache_and_lockfile(monkeypatch):
+    import os
+    import tempfile
+
+    from fusesoc.config import Config
+    from fusesoc.coreindex import CoreIndex
+    from fusesoc.coremanager import CoreDB, CoreManager
+    from fusesoc.librarymanager import Library
+    from fusesoc.vlnv import Vlnv
+
+    cores_root = _write_cores({
+        'top' : """name : ::top:0
+filesets:
+  rtl:
+    depend: ["::dep"]
+targets:
+  default:
+    filesets: [rtl]
+""",
+        'dep' : "name : ::dep:1.0\n",
+    })
+    library = Library('lock', cores_root)
+    config = Config()
+    config.cache_root = tempfile.mkdtemp(prefix='resolve_cache_')
+    flags = {'tool' : 'icarus'}
+
+    solve = CoreDB.solve
+    solved = []
+    def _solve(self, top_core, flags):
+        solved.append(str(top_core))
+        return solve(self, top_core, flags)
+    monkeypatch.setattr(CoreDB, 'solve', _solve)
+
+    def get_depends():
+        cm = CoreManager(config)
+        cm.load_cores(library)
+        return [str(c.name) for c in cm.get_depends(Vlnv('::top'), flags)]
+
+    expected = ['::dep:1.0', '::top:0']
+    assert get_depends() == expected
+    assert get_depends() == expected
+    assert solved == ['::top:0']
+
+    #Cached resolutions from another FuseSoC version are not used
+    signature = CoreIndex.signature()
+    monkeypatch.setattr(CoreIndex, '_signature', 'other_fusesoc')
+    assert get_depends() == expected
+    assert solved == ['::top:0', '::top:0']
+    monkeypatch.setattr(CoreIndex, '_signature', signature)
+
+    #Record the resolution in a lockfile
+    config.lockfile = os.path.join(tempfile.mkdtemp(prefix='lockfile_'), 'fusesoc.lock')
+    config.update_lockfile = True
+    assert get_depends() == expected
+    assert os.path.exists(config.lockfile)
+
+    #The lockfile is used without solving, also with an empty cache
+    config.update_lockfile = False
+    config.cache_root = tempfile.mkdtemp(prefix='resolve_cache_')
+    del solved[:]
+    assert get_depends() == expected
+    assert solved == []
+
+    #Changed cores invalidate the locked resolution
+    with open(os.path.join(cores_root, 'dep.core'), 'a') as f:
+        f.write("description : changed\n")
+    assert get_depends() == expected
+    assert solved == ['::top:0']
+
+def test_greedy_resolver_matches_solver():
+    import os
+
+    from fusesoc.coremanager import CoreDB
+    from fusesoc.core import Core
+    from fusesoc.librarymanager import Library
+
+    tests_dir = os.path.dirname(__file__)
+    for lib in ['cores', 'capi2_cores']:
+        db = CoreDB()
+        library = Library(lib, os.path.join(tests_dir, lib))
+        for root, dirs, files in os.walk(library.location):
+            for f in sorted(files):
+                if f.endswith('.core'):
+                    try:
+                        db.add(Core(os.path.join(root, f)), library)
+                    except Exception:
+                        pass
+
+        for core in db.find():
+            for flags in [{},
+                          {'tool' : 'icarus'},
+                          {'target' : 'sim', 'tool' : 'icarus'}]:
+                try:
+                    expected = db._solve(core.name, flags)
+                except Exception:
+                    continue
+                assert db._resolve_greedy(core.name, flags) == expected
+
+def test_greedy_resolver_falls_back_to_solver():
+    import tempfile
+
+    from fusesoc.config import Config
+    from fusesoc.coremanager import CoreManager
+    from fusesoc.librarymanager import Library
+    from fusesoc.vlnv import Vlnv
+
+    #The latest dep is picked for a, but b needs an older version
+    cores_root = _write_cores({
+        'top' : """name : ::top:0
+filesets:
+  rtl:
+    depend: ["::a", "::b"]
+targets:
+  default:
+    filesets: [rtl]
+""",
+        'a' : """name : ::a:0
+filesets:
+  rtl:
+    depend: ["::dep"]
+targets:
+  default:
+    filesets: [rtl]
+""",
+        'b' : """name : ::b:0
+filesets:
+  rtl:
+    depend: ["<::dep:2.0"]
+targets:
+  default:
+    filesets: [rtl]
+""",
+        'dep_1.0' : "name : ::dep:1.0\n",
+        'dep_2.0' : "name : ::dep:2.0\n",
+    })
+
+    config = Config()
+    config.cache_root = tempfile.mkdtemp(prefix='greedy_cache_')
+    cm = CoreManager(config)
+    cm.load_cores(Library('greedy', cores_root))
+
+    top = Vlnv('::top')
+    assert cm.db._resolve_greedy(top, {}) is None
+    deps = cm.get_depends(top, {})
+    assert [str(c.name) for c in deps] == ['::dep:1.0', '::a:0', '::b:0', '::top:0']
+
+def test_get_depends_many():
+    import tempfile
+
+    from fusesoc.config import Config
+    from fusesoc.coremanager import CoreManager, DependencyError
+    from fusesoc.librarymanager import Library
+    from fusesoc.vlnv import Vlnv
+
+    cores_root = _write_cores({
+        'top' : """name : ::top:0
+filesets:
+  rtl:
+    depend: ["::dep", "tool_icarus? (::sim_model)"]
+  synth:
+    depend: ["::missing"]
+targets:
+  default:
+    filesets: [rtl]
+  synth:
+    filesets: [rtl, synth]
+""",
+        'dep' : "name : ::dep:1.0\n",
+        'sim_model' : "name : ::sim_model:1.0\n",
+    })
+
+    config = Config()
+    config.cache_root = tempfile.mkdtemp(prefix='depends_many_cache_')
+    cm = CoreManager(config)
+    cm.load_cores(Library('depends_many', cores_root))
+
+    flags_list = [{'target' : None,    'tool' : 'icarus'},
+                  {'target' : None,    'tool' : 'verilator'},
+                  {'target' : 'synth', 'tool' : 'vivado'},
+                  {'target' : None,    'tool' : 'icarus'}]
+    results = cm.get_depends_many(Vlnv('::top'), flags_list)
+    assert len(results) == 4
+
+    def names(result):
+        return [str(c.name) for c in result[0]]
+    assert names(results[0]) == ['::dep:1.0', '::sim_model:1.0', '::top:0']
+    assert names(results[1]) == ['::dep:1.0', '::top:0']
+    assert results[2][0] is None
+    assert isinstance(results[2][1], DependencyError)
+    assert results[3] == results[0]
+
+def test_greedy_resolver_prefers_latest_versions():
+    import tempfile
+
+    from fusesoc.config import Config
+    from fusesoc.coremanager import CoreManager
+    from fusesoc.librarymanager import Library
+    from fusesoc.vlnv import Vlnv
+
+    def core(name, depend=None):
+        if not depend:
+            return "name : {}\n".format(name)
+        return """name : {}
+filesets:
+  rtl:
+    depend: ["{}"]
+targets:
+  default:
+    filesets: [rtl]
+""".format(name, depend)
+
+    cores_root = _write_cores({
+        'p0'      : core('::p0:2.0', '>=::p2:1.9'),
+        'p2_1.10' : core('::p2:1.10', '<::p3:1.9'),
+        'p2_1.9'  : core('::p2:1.9', '::p3'),
+        'p3_1.0'  : core('::p3:1.0'),
+        'p3_2.0'  : core('::p3:2.0'),
+    })
+
+    config = Config()
+    config.cache_root = tempfile.mkdtemp(prefix='greedy_cache_')
+    cm = CoreManager(config)
+    cm.load_cores(Library('greedy', cores_root))
+
+    #Without conflicts the latest version of each dependency is picked as
+    #it is reached. The SAT solver can pick another valid set, here
+    #::p2:1.9 and ::p3:2.0
+    top = Vlnv('::p0')
+    expected = ['::p3:1.0', '::p2:1.10', '::p0:2.0']
+    assert [str(c.name) for c in cm.db._resolve_greedy(top, {})] == expected
+    assert [str(c.name) for c in cm.get_depends(top, {})] == expected
@@ -30,3 +30,309 @@ def test_generators():
                           "generate-testgenerate_with_params_0")
     assert os.path.isfile(os.path.join(gendir, "generated.core"))
     assert os.path.isfile(os.path.join(gendir, "testgenerate_with_params_input.yml"))
+
+def test_edam_yaml_roundtrip():
+    import os
+    import tempfile
+
+    from fusesoc.edalizer import Edalizer
+    from fusesoc.core import Core
+    from fusesoc.utils import yaml_fread
+
+    build_root = tempfile.mkdtemp(prefix='edam_yaml_')
+    core_file = os.path.join(build_root, 'env.core')
+    with open(core_file, 'w') as f:
+        f.write("""CAPI=2:
+name : ::envcore:0
+scripts:
+  with_env:
+    cmd : [simple5]
+    env : {TESTENV : testvalue}
+targets:
+  default:
+    hooks:
+      pre_run : [with_env]
+    toplevel : top
+""")
+    core = Core(core_file)
+
+    work_root = os.path.join(build_root, 'work')
+    edalizer = Edalizer(core.name,
+                        {'tool' : 'icarus'},
+                        [core],
+                        cache_root=None,
+                        work_root=work_root)
+    eda_api_file = os.path.join(work_root, 'envcore.eda.yml')
+    edalizer.to_yaml(eda_api_file)
+
+    #CAPI2 strings (e.g. in the script env) must be written as plain strings
+    assert yaml_fread(eda_api_file) == edalizer.edalize
+
+def test_edam_sidecar():
+    import os
+    import tempfile
+
+    from fusesoc.edalizer import Edalizer, load_edam
+    from fusesoc.core import Core
+
+    tests_dir = os.path.dirname(__file__)
+    core = Core(os.path.join(tests_dir, 'cores', 'misc', 'copytocore.core'))
+
+    work_root = tempfile.mkdtemp(prefix='edam_sidecar_')
+    edalizer = Edalizer(core.name, {'tool' : 'icarus'}, [core], None, work_root)
+    eda_api_file = os.path.join(work_root, 'copytocore.eda.yml')
+    edalizer.to_yaml(eda_api_file)
+
+    assert os.path.exists(os.path.join(work_root, 'copytocore.eda.json'))
+    assert load_edam(eda_api_file) == edalizer.edalize
+
+    #A modified EDAM file takes precedence over the sidecar
+    with open(eda_api_file, 'a') as f:
+        f.write("extra : value\n")
+    edam = load_edam(eda_api_file)
+    assert edam['extra'] == 'value'
+    assert edam['files'] == edalizer.edalize['files']
+
+def test_incremental_edalizer():
+    import os
+    import tempfile
+
+    from fusesoc.edalizer import Edalizer
+    from fusesoc.core import Core
+
+    core_root = tempfile.mkdtemp(prefix='incremental_')
+    core_file = os.path.join(core_root, 'incremental.core')
+    with open(core_file, 'w') as f:
+        f.write("""CAPI=2:
+name : ::incremental:0
+filesets:
+  rtl:
+    files:
+      - data.txt : {copyto : copied.txt}
+      - top.v
+    file_type : user
+targets:
+  default:
+    filesets : [rtl]
+    toplevel : top
+""")
+    for name in ['data.txt', 'top.v']:
+        with open(os.path.join(core_root, name), 'w') as f:
+            f.write(name)
+
+    work_root = os.path.join(core_root, 'work')
+    flags = {'tool' : 'icarus'}
+    def edalize():
+        core = Core(core_file)
+        return Edalizer(core.name, flags, [core], None, work_root)
+
+    edalizer = edalize()
+    assert not edalizer.unchanged
+    assert os.path.exists(os.path.join(work_root, 'copied.txt'))
+    assert not edalizer.is_configured([])
+    edalizer.set_configured([])
+
+    #Tool state in the work root survives a rerun with the same inputs
+    with open(os.path.join(work_root, 'tool_state'), 'w') as f:
+        f.write('state')
+    edalizer = edalize()
+    assert edalizer.unchanged
+    assert edalizer.is_configured([])
+    assert not edalizer.is_configured(['--extra'])
+    assert os.path.exists(os.path.join(work_root, 'tool_state'))
+
+    #Changed inputs give a clean work root
+    with open(core_file, 'a') as f:
+        f.write("description : changed\n")
+    edalizer = edalize()
+    assert not edalizer.unchanged
+    assert not edalizer.is_configured([])
+    assert not os.path.exists(os.path.join(work_root, 'tool_state'))
+    assert os.path.exists(os.path.join(work_root, 'copied.txt'))
+
+    #Generators rewrite their cores on every run, but with the same content
+    cores_dir = os.path.join(os.path.dirname(__file__), "capi2_cores", "misc")
+    cache_root = tempfile.mkdtemp(prefix='incremental_cache_')
+    work_root = os.path.join(core_root, 'generate_work')
+    def edalize():
+        core1 = Core(os.path.join(cores_dir, 'generators.core'))
+        core2 = Core(os.path.join(cores_dir, 'generate.core'))
+        return Edalizer(core2.name, flags, [core1, core2], cache_root, work_root)
+
+    edalize().set_configured([])
+    edalizer = edalize()
+    assert edalizer.unchanged
+    assert edalizer.is_configured([])
+
+def test_merge_snippets():
+    from fusesoc.edalizer import _merge_snippets
+
+    #The previous, quadratic implementation
+    def merge_dict(d1, d2):
+        for key, value in d2.items():
+            if isinstance(value, dict):
+                d1[key] = merge_dict(d1.get(key, {}), value)
+            elif isinstance(value, list):
+                d1[key] = d1.get(key, []) + value
+            else:
+                d1[key] = value
+        return d1
+
+    def edam():
+        return {'files' : [], 'hooks' : {}, 'name' : 'top',
+                'parameters' : {}, 'tool_options' : {}, 'vpi' : []}
+
+    snippets = []
+    for i in range(5):
+        snippets.append({
+            'files'        : [{'name' : 'f{}_{}'.format(i, j)} for j in range(3)],
+            'hooks'        : {'pre_build' : [{'name' : 'h{}'.format(i)}]} if i % 2 else {},
+            'parameters'   : {'p' : {'default' : i}, 'p{}'.format(i) : {'default' : i}},
+            'tool_options' : {'icarus' : {'iverilog_options' : ['-o{}'.format(i)],
+                                          'timescale' : str(i)}},
+            'vpi'          : [],
+        })
+
+    expected = edam()
+    for snippet in snippets:
+        merge_dict(expected, snippet)
+    merged = _merge_snippets(edam(), snippets)
+    assert merged == expected
+    assert [f['name'] for f in merged['files']][:4] == ['f0_0', 'f0_1', 'f0_2', 'f1_0']
+    assert merged['parameters']['p'] == {'default' : 4}
+    assert merged['tool_options']['icarus']['iverilog_options'] == \
+        ['-o0', '-o1', '-o2', '-o3', '-o4']
+
+    #Merged lists are new lists
+    assert merged['files'] is not snippets[0]['files']
+
+def test_write_edam():
+    import hashlib
+    import io
+
+    from fusesoc import edalizer
+    from fusesoc.utils import yaml_dump
+
+    edam = {'files' : [{'name' : 'src/f{}.v'.format(i),
+                        'file_type' : 'verilogSource',
+                        'is_include_file' : bool(i % 2)} for i in range(25)],
+            'hooks' : {'pre_build' : [{'name' : 'h', 'cmd' : ['make', 'x']}]},
+            'name' : 'top',
+            'parameters' : {'p' : {'datatype' : 'int', 'default' : 1}},
+            'tool_options' : {'icarus' : {'iverilog_options' : ['-g2012']}},
+            'toplevel' : 'top',
+            'version' : '0.2.0',
+            'vpi' : []}
+
+    #Writing in chunks gives the same text as dumping the whole EDAM
+    chunk_size = edalizer.EDAM_CHUNK_SIZE
+    try:
+        edalizer.EDAM_CHUNK_SIZE = 7
+        f = io.StringIO()
+        yaml_sha1 = edalizer._write_edam(f, edam)
+    finally:
+        edalizer.EDAM_CHUNK_SIZE = chunk_size
+    data = yaml_dump(edam)
+    assert f.getvalue() == data
+    assert yaml_sha1 == hashlib.sha1(data.encode('utf-8')).hexdigest()
+
+def test_setup_cores():
+    import threading
+
+    import pytest
+    import time
+
+    from fusesoc.edalizer import setup_cores
+
+    lock = threading.Lock()
+    state = {'running' : 0, 'max_running' : 0, 'fetched' : []}
+
+    class SlowCore(object):
+        def __init__(self, name, provider):
+            self.name = name
+            self.provider = provider
+        def setup(self):
+            with lock:
+                state['running'] += 1
+                state['max_running'] = max(state['max_running'], state['running'])
+            time.sleep(0.05)
+            with lock:
+                state['running'] -= 1
+                state['fetched'].append(self.name)
+
+    cores = [SlowCore('remote{}'.format(i), True) for i in range(6)]
+    cores.append(SlowCore('local', None))
+
+    progress = []
+    setup_cores(cores, 3, lambda core, seconds, error: progress.append(core.name))
+    assert sorted(state['fetched']) == ['remote{}'.format(i) for i in range(6)]
+    assert 1 < state['max_running'] <= 3
+    assert progress == state['fetched']
+
+    #Errors from a fetch are passed on
+    class FailingCore(SlowCore):
+        def setup(self):
+            raise RuntimeError("Failed to fetch")
+    with pytest.raises(RuntimeError):
+        setup_cores(cores[:2] + [FailingCore('failing', True)], jobs=3)
+
+def test_incremental_export():
+    import os
+    import tempfile
+
+    from fusesoc.edalizer import Edalizer
+    from fusesoc.core import Core
+
+    core_root = tempfile.mkdtemp(prefix='incremental_export_')
+    core_file = os.path.join(core_root, 'export.core')
+    def write_core(files):
+        with open(core_file, 'w') as f:
+            f.write("""CAPI=2:
+name : ::incremental_export:0
+filesets:
+  rtl:
+    files: [{}]
+    file_type : verilogSource
+targets:
+  default:
+    filesets : [rtl]
+    toplevel : top
+""".format(', '.join(files)))
+    for name in ['top.v', 'sub.v']:
+        with open(os.path.join(core_root, name), 'w') as f:
+            f.write(name)
+
+    build_root = os.path.join(core_root, 'build')
+    export_root = os.path.join(build_root, 'src')
+    exported = os.path.join(export_root, 'incremental_export_0', 'top.v')
+    def edalize():
+        core = Core(core_file)
+        return Edalizer(core.name, {'tool' : 'icarus'}, [core], None,
+                        os.path.join(build_root, 'work'), export_root)
+
+    write_core(['top.v', 'sub.v'])
+    edalize().set_configured([])
+    mtime = os.stat(exported).st_mtime
+
+    #Unchanged sources are not exported again
+    assert edalize().unchanged
+    assert os.stat(exported).st_mtime == mtime
+
+    #Changed sources are, and files that are no longer used are removed
+    with open(os.path.join(core_root, 'top.v'), 'a') as f:
+        f.write('changed')
+    write_core(['top.v'])
+    edalize()
+    with open(exported) as f:
+        assert f.read() == 'top.vchanged'
+    assert os.listdir(os.path.dirname(exported)) == ['top.v']
+
+    #Also when restored with the same size and an older mtime
+    top = os.path.join(core_root, 'top.v')
+    st = os.stat(top)
+    with open(top, 'w') as f:
+        f.write('top.vCHANGED')
+    os.utime(top, (st.st_atime - 100, st.st_mtime - 100))
+    edalize()
+    with open(exported) as f:
+        assert f.read() == 'top.vCHANGED'
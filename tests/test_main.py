@@ -1,3 +1,6 @@
+import os
+import sys
+
 import pytest
 
 from fusesoc.main import sim
@@ -40,3 +43,262 @@ def test_sim(capsys):
     import sys
     if sys.version_info[0] > 2:
         assert err == "No tool was supplied on command line or found in 'wb_common' core description\n"
+
+def test_run_backend_skips_library_scan():
+    import os
+    import tempfile
+
+    from fusesoc.config import Config
+    from fusesoc.coremanager import CoreManager
+    from fusesoc.librarymanager import Library
+    from fusesoc.main import run_backend
+
+    cores_root = tempfile.mkdtemp(prefix='run_record_cores_')
+    with open(os.path.join(cores_root, 'top.core'), 'w') as f:
+        f.write("""CAPI=2:
+name : ::run_record_top:0
+targets:
+  default:
+    default_tool : icarus
+    toplevel : top
+""")
+
+    config = Config()
+    config.build_root = tempfile.mkdtemp(prefix='run_record_build_')
+    config.cache_root = tempfile.mkdtemp(prefix='run_record_cache_')
+
+    def core_manager():
+        cm = CoreManager(config)
+        cm._lm._libraries = []
+        cm.add_library(Library('run_record', cores_root))
+        return cm
+
+    cm = core_manager()
+    run_backend(cm, False, True, False, False, {'tool' : None, 'target' : None},
+                None, 'run_record_top', [], None)
+    work_root = os.path.join(config.build_root, 'run_record_top_0', 'default-icarus')
+    assert os.path.exists(os.path.join(work_root, 'run_record_top_0.eda.yml'))
+
+    #Reconfiguring with unchanged inputs keeps the work root
+    with open(os.path.join(work_root, 'tool_state'), 'w') as f:
+        f.write('state')
+    cm = core_manager()
+    run_backend(cm, False, True, False, False, {'tool' : None, 'target' : None},
+                None, 'run_record_top', [], None)
+    assert os.path.exists(os.path.join(work_root, 'tool_state'))
+
+    #Build/run-only invocations use the existing EDAM without scanning
+    cm = core_manager()
+    run_backend(cm, False, False, False, False, {'tool' : None, 'target' : None},
+                None, 'run_record_top', [], None)
+    assert cm._pending_libraries
+
+    #A new version of the core invalidates the record
+    with open(os.path.join(cores_root, 'top_1.core'), 'w') as f:
+        f.write("""CAPI=2:
+name : ::run_record_top:1
+targets:
+  default:
+    default_tool : icarus
+    toplevel : top
+""")
+    cm = core_manager()
+    run_backend(cm, False, False, False, False, {'tool' : None, 'target' : None},
+                None, 'run_record_top', [], None)
+    assert not cm._pending_libraries
+    assert os.path.exists(os.path.join(config.build_root, 'run_record_top_1',
+                                       'default-icarus', 'run_record_top_1.eda.yml'))
+
+@pytest.mark.skipif(sys.version_info < (3, 7), reason="requires -X importtime")
+def test_import_budget():
+    import subprocess
+
+    #Heavy dependencies must only be imported by the commands using them
+    deferred = ['edalize', 'ipyxact', 'okonomiyaki', 'pyparsing',
+                'simplesat', 'yaml', 'fusesoc.core', 'fusesoc.capi1',
+                'fusesoc.capi2', 'fusesoc.edalizer']
+
+    output = subprocess.check_output(
+        [sys.executable, '-X', 'importtime', '-c', 'import fusesoc.main'],
+        stderr=subprocess.STDOUT,
+        cwd=os.path.dirname(tests_dir)).decode()
+
+    imported = []
+    for line in output.splitlines():
+        if line.startswith('import time:') and not 'cumulative' in line:
+            imported.append(line.split('|')[-1].strip())
+
+    assert 'fusesoc.main' in imported
+    for module in imported:
+        assert module.split('.')[0] not in deferred
+        assert '.'.join(module.split('.')[:2]) not in deferred
+
+def test_core_resolve(capsys):
+    import tempfile
+
+    from fusesoc.config import Config
+    from fusesoc.coremanager import CoreManager
+    from fusesoc.librarymanager import Library
+    from fusesoc.main import core_resolve
+
+    cores_root = tempfile.mkdtemp(prefix='core_resolve_cores_')
+    for name, data in [('top', """name : ::core_resolve_top:0
+filesets:
+  rtl:
+    depend: ["::core_resolve_dep"]
+targets:
+  default:
+    default_tool : icarus
+    filesets: [rtl]
+"""),
+                       ('dep', "name : ::core_resolve_dep:1.0\n")]:
+        with open(os.path.join(cores_root, name + '.core'), 'w') as f:
+            f.write("CAPI=2:\n" + data)
+
+    config = Config()
+    config.cache_root = tempfile.mkdtemp(prefix='core_resolve_cache_')
+    cm = CoreManager(config)
+    cm._lm._libraries = []
+    cm.add_library(Library('core_resolve', cores_root))
+
+    class Args():
+        core = 'core_resolve_top'
+        combination = [':', ':verilator']
+
+    core_resolve(cm, Args())
+    out, err = capsys.readouterr()
+    assert out == """target default, tool icarus :
+  ::core_resolve_dep:1.0
+  ::core_resolve_top:0
+target default, tool verilator :
+  ::core_resolve_dep:1.0
+  ::core_resolve_top:0
+"""
+
+    #Conflicts are explained
+    for name, data in [('conflict', """name : ::core_resolve_conflict:0
+filesets:
+  rtl:
+    depend: ["=::core_resolve_dep:1.0", "::core_resolve_new"]
+targets:
+  default:
+    default_tool : icarus
+    filesets: [rtl]
+"""),
+                       ('new', """name : ::core_resolve_new:0
+filesets:
+  rtl:
+    depend: [">=::core_resolve_dep:2.0"]
+targets:
+  default:
+    filesets: [rtl]
+"""),
+                       ('dep2', "name : ::core_resolve_dep:2.0\n")]:
+        with open(os.path.join(cores_root, name + '.core'), 'w') as f:
+            f.write("CAPI=2:\n" + data)
+    cm = CoreManager(config)
+    cm._lm._libraries = []
+    cm.add_library(Library('core_resolve', cores_root))
+
+    Args.core = 'core_resolve_conflict'
+    Args.combination = [':']
+    with pytest.raises(SystemExit):
+        core_resolve(cm, Args())
+    out, err = capsys.readouterr()
+    assert out.startswith("target default, tool icarus : ")
+    assert "Conflicting requirements" in out
+    assert not "but this core was not found" in out
+
+def test_fetch(capsys):
+    import tempfile
+
+    from fusesoc.config import Config
+    from fusesoc.coremanager import CoreManager
+    from fusesoc.librarymanager import Library
+    from fusesoc.main import fetch
+
+    cores_root = tempfile.mkdtemp(prefix='fetch_cores_')
+    remote_root = tempfile.mkdtemp(prefix='fetch_remote_')
+    for name in ['sim_dep', 'synth_dep']:
+        with open(os.path.join(remote_root, name + '.v'), 'w') as f:
+            f.write("module {}; endmodule\n".format(name))
+        with open(os.path.join(cores_root, name + '.core'), 'w') as f:
+            f.write("""CAPI=2:
+name : ::fetch_{0}:1.0
+provider:
+  name : url
+  url : file://{1}
+  filetype : simple
+""".format(name, os.path.join(remote_root, name + '.v')))
+    with open(os.path.join(cores_root, 'top.core'), 'w') as f:
+        f.write("""CAPI=2:
+name : ::fetch_top:0
+filesets:
+  sim:
+    depend: ["::fetch_sim_dep"]
+  synth:
+    depend: ["::fetch_synth_dep"]
+targets:
+  sim:
+    default_tool : icarus
+    filesets: [sim]
+  synth:
+    default_tool : vivado
+    filesets: [synth]
+""")
+
+    config = Config()
+    config.cache_root = tempfile.mkdtemp(prefix='fetch_cache_')
+    config.jobs = 2
+    cm = CoreManager(config)
+    cm._lm._libraries = []
+    cm.add_library(Library('fetch', cores_root))
+
+    class Args():
+        core = 'fetch_top'
+        combination = ['sim:', 'synth:']
+
+    fetch(cm, Args())
+    out, err = capsys.readouterr()
+    for name in ['sim_dep', 'synth_dep']:
+        assert os.path.exists(os.path.join(config.cache_root,
+                                           'fetch_{}_1.0'.format(name),
+                                           name + '.v'))
+    assert out.splitlines()[0].startswith("url : 2 cores, 2 fetched, 54 B in ")
+    assert out.splitlines()[1].startswith("Fetched 2 of 2 remote cores in ")
+
+    #Cores that are already in the cache are not fetched again
+    fetch(cm, Args())
+    out, err = capsys.readouterr()
+    assert out.splitlines()[0] == "url : 2 cores, 0 fetched, 0 B in 0.0s"
+
+def test_run_record_home_library(monkeypatch):
+    import tempfile
+
+    from fusesoc.config import Config
+    from fusesoc.coremanager import CoreManager
+    from fusesoc.librarymanager import Library
+    from fusesoc.main import _core_file_stats
+
+    home = tempfile.mkdtemp(prefix='run_record_home_')
+    monkeypatch.setenv('HOME', home)
+    core_dir = os.path.join(home, 'cores', 'top')
+    os.makedirs(core_dir)
+    core_file = os.path.join(core_dir, 'top.core')
+    with open(core_file, 'w') as f:
+        f.write("CAPI=2:\nname : ::top:0\n")
+
+    config = Config()
+    config.cache_root = tempfile.mkdtemp(prefix='run_record_cache_')
+    cm = CoreManager(config)
+    cm._lm._libraries = []
+    cm.add_library(Library('home', '~/cores'))
+
+    class Core():
+        pass
+    core = Core()
+    core.core_file = core_file
+
+    #Only the paths inside the library are recorded
+    assert sorted(_core_file_stats(cm, [core])) == \
+        [os.path.join(home, 'cores'), core_dir, core_file]
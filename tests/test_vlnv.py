@@ -64,3 +64,60 @@ def test_name_revision_legacy():
     assert vlnv_tuple(Vlnv("uart16550-r2")) == \
     ('', '', 'uart16550', '0', 2)
 
+def test_vlnv_hash():
+    from fusesoc.vlnv import Vlnv
+
+    assert Vlnv('::a:1.0') == Vlnv('=::a:1.0')
+    assert hash(Vlnv('::a:1.0')) == hash(Vlnv('>=::a:1.0'))
+    assert Vlnv('::a:1.0') != Vlnv('::a:1.1')
+    assert len({Vlnv('::a:1.0'), Vlnv('::a:1.0'), Vlnv('::b:1.0')}) == 2
+
+def test_vlnv_parse_cache():
+    import pickle
+
+    from fusesoc.vlnv import Vlnv
+
+    #Cached parses must still give independent objects
+    a = Vlnv('::a:1.0-r2')
+    b = Vlnv('::a:1.0-r2')
+    assert a is not b
+    a.relation = '>='
+    assert b.relation == '=='
+    assert (b.version, b.revision) == ('1.0', 2)
+    assert b.sanitized_name == 'a_1.0-r2'
+
+    c = pickle.loads(pickle.dumps(b, pickle.HIGHEST_PROTOCOL))
+    assert c == b
+    assert (c.relation, c.sanitized_name) == ('==', 'a_1.0-r2')
+
+def test_vlnv_version_order():
+    import itertools
+
+    from okonomiyaki.versions import EnpkgVersion
+
+    from fusesoc.vlnv import Vlnv, version_key
+
+    versions = ['0', '1.0', '1.0.0', '1.9', '1.10', '1.10.1', '2.0a1',
+                '2.0b2', '2.0c1', '2.0rc2', '2.0.dev3', '2.0.post1',
+                '2.0.post1.dev2', '2.0', '1.01', '1.x', '20040603']
+    for (a, ra), (b, rb) in itertools.product(itertools.product(versions, [0, 2]),
+                                              repeat=2):
+        ea = EnpkgVersion.from_string("{}-{}".format(a, ra))
+        eb = EnpkgVersion.from_string("{}-{}".format(b, rb))
+        ka = version_key(a, ra)
+        kb = version_key(b, rb)
+        assert (ka < kb) == (ea < eb)
+        assert (ka == kb) == (ea == eb)
+
+    assert version_key('1.0-rc1') is None
+
+    names = ['::a:1.10', '::a:1.9-r1', '::a:1.9', '::a:1.0-rc1', '::a:2.0rc1']
+    assert [str(v) for v in sorted(Vlnv(n) for n in names)] == \
+        ['::a:1.0-rc1', '::a:1.9', '::a:1.9-r1', '::a:1.10', '::a:2.0rc1']
+
+    #Equality, ordering and hashing agree with each other
+    a, b = Vlnv('::a:1.9'), Vlnv('::a:1.9-r1')
+    assert a != b and a < b and b > a and not b < a
+    a, b = Vlnv('::a:1.0'), Vlnv('::a:1.0.0')
+    assert a == b and not a < b and not b < a and not a > b
+    assert hash(a) == hash(b)